@@ -0,0 +1,335 @@
+#!/usr/bin/python3
+
+"""
+Make a pair of synthetic gedcom trees for timing the comparison program.
+Arguments: number-of-people  output-prefix
+
+The first tree is descended from a single couple, with marriages to people
+from outside the family, several children per couple, remarriages, etc.
+The second tree is a copy with a fraction of the people edited:
+renamed, dates shifted, children added or removed, partners added or removed.
+
+Writes prefix-1.ged and prefix-2.ged
+The starting person in both trees is xref @I1@
+
+Options:
+--edit-rate (default 0.01)
+--seed (default 1)
+
+This code is released under the MIT License: https://opensource.org/licenses/MIT
+Copyright (c) 2021 John A. Andrea
+"""
+
+import sys
+import random
+import argparse
+
+
+given_names = dict()
+given_names['M'] = ['John', 'William', 'James', 'George', 'Charles', 'Thomas', 'Henry', 'Robert',
+                    'Joseph', 'Edward', 'Samuel', 'David', 'Richard', 'Frederick', 'Arthur', 'Walter',
+                    'Albert', 'Alfred', 'Daniel', 'Peter', 'Francis', 'Benjamin', 'Isaac', 'Jacob',
+                    'Hugh', 'Archibald', 'Duncan', 'Angus', 'Malcolm', 'Neil', 'Patrick', 'Michael',
+                    'Stephen', 'Matthew', 'Andrew', 'Alexander', 'Donald', 'Kenneth', 'Lewis', 'Owen']
+given_names['F'] = ['Mary', 'Elizabeth', 'Sarah', 'Margaret', 'Ann', 'Jane', 'Catherine', 'Ellen',
+                    'Martha', 'Emma', 'Alice', 'Eliza', 'Harriet', 'Hannah', 'Isabella', 'Agnes',
+                    'Janet', 'Christina', 'Flora', 'Jessie', 'Annie', 'Helen', 'Louisa', 'Charlotte',
+                    'Caroline', 'Frances', 'Susan', 'Rebecca', 'Rachel', 'Lydia', 'Esther', 'Ruth',
+                    'Grace', 'Florence', 'Edith', 'Ada', 'Clara', 'Maud', 'Amelia', 'Julia']
+
+months = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
+
+
+def get_program_options():
+    results = dict()
+
+    results['edit-rate'] = 0.01
+    results['seed'] = 1
+
+    arg_help = 'Make a pair of synthetic gedcom trees.'
+    parser = argparse.ArgumentParser( description=arg_help )
+
+    arg_help = 'Fraction of people edited in the second tree. Default ' + str(results['edit-rate'])
+    parser.add_argument( '--edit-rate', default=results['edit-rate'], type=float, help=arg_help )
+
+    arg_help = 'Random number seed, the same seed makes the same trees. Default ' + str(results['seed'])
+    parser.add_argument( '--seed', default=results['seed'], type=int, help=arg_help )
+
+    parser.add_argument('people', type=int )
+    parser.add_argument('prefix', type=str )
+
+    args = parser.parse_args()
+
+    results['edit-rate'] = args.edit_rate
+    results['seed'] = args.seed
+    results['people'] = args.people
+    results['prefix'] = args.prefix
+
+    return results
+
+
+def make_word_list( n, min_syllables, max_syllables ):
+    # made up names, so that there are many different ones
+    starts = ['b','c','d','f','g','h','j','k','l','m','n','p','r','s','t','w','br','ch','cr','gr','st','th']
+    vowels = ['a','e','i','o','u','ai','ea','ou']
+    ends = ['','n','r','l','s','t','ck','ll','rd','ng','son','ton','ley','ford']
+    result = set()
+    while len( result ) < n:
+        word = ''
+        for i in range( random.randint( min_syllables, max_syllables ) ):
+            word += random.choice( starts ) + random.choice( vowels )
+        word += random.choice( ends )
+        result.add( word.capitalize() )
+    return sorted( result )
+
+
+class Tree:
+    # people and families held in parallel lists so that a million people fit
+
+    def __init__( self ):
+        self.given = []
+        self.surname = []
+        self.sex = []
+        self.birth = []
+        self.death = []
+        self.birth_place = []
+        self.death_place = []
+        self.famc = []
+        self.fams = []
+        self.husb = []
+        self.wife = []
+        self.chil = []
+
+    def add_person( self, given, surname, sex, birth, death, birth_place, death_place ):
+        self.given.append( given )
+        self.surname.append( surname )
+        self.sex.append( sex )
+        self.birth.append( birth )
+        self.death.append( death )
+        self.birth_place.append( birth_place )
+        self.death_place.append( death_place )
+        self.famc.append( None )
+        self.fams.append( [] )
+        return len( self.given ) - 1
+
+    def add_family( self, husb, wife ):
+        self.husb.append( husb )
+        self.wife.append( wife )
+        self.chil.append( [] )
+        f = len( self.husb ) - 1
+        for p in [husb, wife]:
+            if p is not None:
+               self.fams[p].append( f )
+        return f
+
+    def add_child( self, f, c ):
+        self.chil[f].append( c )
+        self.famc[c] = f
+
+    def copy( self ):
+        result = Tree()
+        for attr in vars( self ):
+            values = getattr( self, attr )
+            if attr in ['fams', 'chil']:
+               values = [list(x) for x in values]
+            else:
+               values = list( values )
+            setattr( result, attr, values )
+        return result
+
+
+def random_life( year, places ):
+    # birth and death as [year,month,day], death might be unknown
+    birth = [year, random.randint(1,12), random.randint(1,28)]
+    death = None
+    if random.random() < 0.7:
+       death = [year + random.randint(1,90), random.randint(1,12), random.randint(1,28)]
+    return birth, death, random.choice( places ), random.choice( places )
+
+
+def make_person( tree, sex, surname, year, places ):
+    birth, death, birth_place, death_place = random_life( year, places )
+    given = random.choice( given_names[sex] )
+    return tree.add_person( given, surname, sex, birth, death, birth_place, death_place )
+
+
+def make_children( tree, f, year, surname, places, minimum=0 ):
+    used = set()
+    for i in range( max( minimum, random.choice( [0,1,2,2,3,3,4,5,6,8] ) ) ):
+        sex = random.choice( ['M','F'] )
+        birth, death, birth_place, death_place = random_life( year + 2 * i, places )
+        # siblings rarely have the same name
+        given = random.choice( given_names[sex] )
+        while given in used:
+            given = random.choice( given_names[sex] )
+        used.add( given )
+        c = tree.add_person( given, surname, sex, birth, death, birth_place, death_place )
+        tree.add_child( f, c )
+
+
+def make_tree( n_people, surnames, places ):
+    tree = Tree()
+
+    # the starting person and their partner
+    p = make_person( tree, 'M', random.choice( surnames ), 1700, places )
+    waiting = [p]
+
+    next_waiting = 0
+    while next_waiting < len( waiting ) and len( tree.given ) < n_people:
+        p = waiting[next_waiting]
+        next_waiting += 1
+
+        # the starting person always has a family
+        is_start = next_waiting == 1
+
+        if is_start or random.random() < 0.85:
+           n_partners = 1
+           if random.random() < 0.15:
+              n_partners = 2
+           for i in range( n_partners ):
+               partner_sex = 'F' if tree.sex[p] == 'M' else 'M'
+               partner = make_person( tree, partner_sex, random.choice( surnames ), tree.birth[p][0] + random.randint(-5,5), places )
+               if tree.sex[p] == 'M':
+                  f = tree.add_family( p, partner )
+                  surname = tree.surname[p]
+               else:
+                  f = tree.add_family( partner, p )
+                  surname = tree.surname[partner]
+               n_before = len( tree.given )
+               make_children( tree, f, tree.birth[p][0] + 22 + 8 * i, surname, places, 4 if is_start else 0 )
+               waiting.extend( range( n_before, len( tree.given ) ) )
+
+    return tree
+
+
+def misspell( name ):
+    # a small change, which might or might not still match
+    i = random.randrange( len(name) )
+    change = random.choice( ['drop','double','swap'] )
+    if change == 'drop' and len(name) > 3:
+       return name[:i] + name[i+1:]
+    if change == 'double':
+       return name[:i] + name[i] + name[i:]
+    if i < len(name) - 1:
+       return name[:i] + name[i+1] + name[i] + name[i+2:]
+    return name + 'e'
+
+
+def edit_tree( tree, edit_rate, places ):
+    # return a copy with some people changed, and counts of the changes
+    result = tree.copy()
+    counts = dict()
+    for change in ['rename','redate','add-child','remove-child','add-partner','remove-partner']:
+        counts[change] = 0
+
+    n_people = len( tree.given )
+    for p in range( n_people ):
+        if random.random() >= edit_rate:
+           continue
+
+        change = random.choice( list(counts) )
+
+        if change == 'rename':
+           result.given[p] = misspell( result.given[p] )
+
+        elif change == 'redate':
+           # years, some within the default person match tolerance, some not
+           shift = random.choice( [1, 2, 20] )
+           result.birth[p] = [result.birth[p][0] + shift, result.birth[p][1], result.birth[p][2]]
+
+        elif change == 'add-child':
+           if not result.fams[p]:
+              continue
+           f = result.fams[p][0]
+           surname = result.surname[result.husb[f]] if result.husb[f] is not None else result.surname[p]
+           make_children( result, f, result.birth[p][0] + 30, surname, places )
+
+        elif change == 'remove-child':
+           f = result.famc[p]
+           if f is None:
+              continue
+           result.chil[f].remove( p )
+           result.famc[p] = None
+
+        elif change == 'add-partner':
+           partner_sex = 'F' if result.sex[p] == 'M' else 'M'
+           partner = make_person( result, partner_sex, result.surname[p], result.birth[p][0], places )
+           if result.sex[p] == 'M':
+              result.add_family( p, partner )
+           else:
+              result.add_family( partner, p )
+
+        elif change == 'remove-partner':
+           if not result.fams[p]:
+              continue
+           f = result.fams[p].pop()
+           if result.husb[f] == p:
+              result.husb[f] = None
+           else:
+              result.wife[f] = None
+
+        counts[change] += 1
+
+    return result, counts
+
+
+def write_date( outf, date ):
+    outf.write( '2 DATE ' + str(date[2]) + ' ' + months[date[1]-1] + ' ' + str(date[0]) + '\n' )
+
+
+def write_tree( tree, file_name ):
+    with open( file_name, 'w', encoding='utf-8' ) as outf:
+         outf.write( '0 HEAD\n1 SOUR make-trees\n1 GEDC\n2 VERS 5.5.1\n2 FORM LINEAGE-LINKED\n1 CHAR UTF-8\n' )
+         for p in range( len( tree.given ) ):
+             outf.write( '0 @I' + str(p+1) + '@ INDI\n' )
+             outf.write( '1 NAME ' + tree.given[p] + ' /' + tree.surname[p] + '/\n' )
+             outf.write( '1 SEX ' + tree.sex[p] + '\n' )
+             outf.write( '1 BIRT\n' )
+             write_date( outf, tree.birth[p] )
+             outf.write( '2 PLAC ' + tree.birth_place[p] + '\n' )
+             if tree.death[p]:
+                outf.write( '1 DEAT\n' )
+                write_date( outf, tree.death[p] )
+                outf.write( '2 PLAC ' + tree.death_place[p] + '\n' )
+             if tree.famc[p] is not None:
+                outf.write( '1 FAMC @F' + str(tree.famc[p]+1) + '@\n' )
+             for f in tree.fams[p]:
+                 outf.write( '1 FAMS @F' + str(f+1) + '@\n' )
+         for f in range( len( tree.husb ) ):
+             outf.write( '0 @F' + str(f+1) + '@ FAM\n' )
+             if tree.husb[f] is not None:
+                outf.write( '1 HUSB @I' + str(tree.husb[f]+1) + '@\n' )
+             if tree.wife[f] is not None:
+                outf.write( '1 WIFE @I' + str(tree.wife[f]+1) + '@\n' )
+             for c in tree.chil[f]:
+                 outf.write( '1 CHIL @I' + str(c+1) + '@\n' )
+         outf.write( '0 TRLR\n' )
+
+
+options = get_program_options()
+
+if options['people'] < 2:
+   print( 'Need at least 2 people', file=sys.stderr )
+   sys.exit(1)
+if options['edit-rate'] < 0 or options['edit-rate'] > 1:
+   print( 'Edit rate must be from 0 to 1', file=sys.stderr )
+   sys.exit(1)
+
+random.seed( options['seed'] )
+
+surnames = make_word_list( 2000, 1, 3 )
+places = []
+for county in make_word_list( 60, 2, 3 ):
+    for parish in make_word_list( 40, 1, 3 ):
+        places.append( parish + ', ' + county + ', England' )
+
+tree1 = make_tree( options['people'], surnames, places )
+tree2, changes = edit_tree( tree1, options['edit-rate'], places )
+
+write_tree( tree1, options['prefix'] + '-1.ged' )
+write_tree( tree2, options['prefix'] + '-2.ged' )
+
+print( 'people', len( tree1.given ), len( tree2.given ) )
+print( 'families', len( tree1.husb ), len( tree2.husb ) )
+for change in changes:
+    print( change, changes[change] )
@@ -0,0 +1,223 @@
+#!/usr/bin/python3
+
+"""
+Time the comparison program on synthetic trees of increasing size.
+Arguments: none required
+
+For each size a pair of trees is made with make-trees.py (and kept for re-use)
+then diff.py is run in a separate process which reports the time of each phase
+and its peak memory. Results are appended to a file as json lines so that runs
+of different program versions can be compared.
+
+Options:
+--sizes (default 1000,10000,100000)
+--edit-rate (default 0.01)
+--libpath (default '.', relative to diff.py as for diff.py itself)
+--data-dir (default 'data', relative to this program)
+--results (default 'results.jsonl')
+--label (default none)
+--compare old-results new-results
+Any arguments after "--" are passed on to diff.py
+
+This code is released under the MIT License: https://opensource.org/licenses/MIT
+Copyright (c) 2021 John A. Andrea
+"""
+
+import sys
+import os
+import json
+import time
+import argparse
+import subprocess
+
+
+def get_program_options():
+    results = dict()
+
+    results['sizes'] = '1000,10000,100000'
+    results['edit-rate'] = 0.01
+    results['libpath'] = '.'
+    results['data-dir'] = 'data'
+    results['results'] = 'results.jsonl'
+    results['label'] = None
+    results['compare'] = None
+
+    arg_help = 'Time the tree comparison on synthetic trees.'
+    parser = argparse.ArgumentParser( description=arg_help )
+
+    arg_help = 'Comma separated numbers of people. Default ' + results['sizes']
+    parser.add_argument( '--sizes', default=results['sizes'], type=str, help=arg_help )
+
+    arg_help = 'Fraction of people edited in the second tree. Default ' + str(results['edit-rate'])
+    parser.add_argument( '--edit-rate', default=results['edit-rate'], type=float, help=arg_help )
+
+    arg_help = 'Location of the gedcom library, as given to diff.py. Default ' + results['libpath']
+    parser.add_argument( '--libpath', default=results['libpath'], type=str, help=arg_help )
+
+    arg_help = 'Directory for the generated trees. Default ' + results['data-dir']
+    parser.add_argument( '--data-dir', default=results['data-dir'], type=str, help=arg_help )
+
+    arg_help = 'File to which results are appended. Default ' + results['results']
+    parser.add_argument( '--results', default=results['results'], type=str, help=arg_help )
+
+    arg_help = 'Name for this set of results, such as a version or branch.'
+    parser.add_argument( '--label', default=results['label'], type=str, help=arg_help )
+
+    arg_help = 'Compare two results files, rather than running.'
+    parser.add_argument( '--compare', default=results['compare'], nargs=2, type=str, help=arg_help )
+
+    parser.add_argument( '--child', default=None, type=str, help=argparse.SUPPRESS )
+
+    parser.add_argument( 'diff_options', nargs='*' )
+
+    args = parser.parse_args()
+
+    results['sizes'] = [int(x) for x in args.sizes.split(',')]
+    results['edit-rate'] = args.edit_rate
+    results['libpath'] = args.libpath
+    results['data-dir'] = args.data_dir
+    results['results'] = args.results
+    results['label'] = args.label
+    results['compare'] = args.compare
+    results['child'] = args.child
+    results['diff-options'] = args.diff_options
+
+    return results
+
+
+def program_dir():
+    return os.path.dirname( os.path.realpath( __file__ ) )
+
+
+def run_child( result_file, diff_args ):
+    # runs in its own process so that memory and time are only for one comparison
+    import runpy
+    import resource
+
+    # the phase times and counts come from diff.py itself
+    stats_file = result_file + '.stats'
+    sys.argv = ['diff.py', '--stats-file', stats_file] + diff_args
+    diff_file = os.path.join( program_dir(), '..', 'diff.py' )
+
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+       runpy.run_path( diff_file, run_name='__main__' )
+    except SystemExit as e:
+       if e.code:
+          raise
+    wall = time.perf_counter() - wall
+    cpu = time.process_time() - cpu
+
+    result = dict()
+    result['wall'] = wall
+    result['cpu'] = cpu
+    # kilobytes on linux
+    result['peak-memory'] = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+
+    with open( stats_file ) as inf:
+         stats = json.load( inf )
+    os.remove( stats_file )
+
+    # wall time of each phase
+    result['phases'] = dict()
+    for phase in stats['phases']:
+        result['phases'][phase] = stats['phases'][phase]['wall']
+    result['counters'] = stats['counters']
+
+    with open( result_file, 'w' ) as outf:
+         json.dump( result, outf )
+
+
+def make_trees( size, edit_rate, data_dir ):
+    prefix = os.path.join( data_dir, 'synthetic-' + str(size) + '-' + str(edit_rate) )
+    if not os.path.isfile( prefix + '-2.ged' ):
+       print( 'Making trees of', size, 'people', file=sys.stderr )
+       maker = os.path.join( program_dir(), 'make-trees.py' )
+       subprocess.run( [sys.executable, maker, '--edit-rate', str(edit_rate), str(size), prefix],
+                       check=True, stdout=subprocess.DEVNULL )
+    return prefix + '-1.ged', prefix + '-2.ged'
+
+
+def run_benchmark( options ):
+    data_dir = options['data-dir']
+    if not os.path.isabs( data_dir ):
+       data_dir = os.path.join( program_dir(), data_dir )
+    os.makedirs( data_dir, exist_ok=True )
+
+    result_file = os.path.join( data_dir, 'child-result.json' )
+
+    for size in options['sizes']:
+        file1, file2 = make_trees( size, options['edit-rate'], data_dir )
+
+        diff_args = ['--libpath', options['libpath'], '--output', os.devnull]
+        diff_args.extend( options['diff-options'] )
+        diff_args.extend( [file1, '@I1@', file2, '@I1@'] )
+
+        print( 'Comparing', size, 'people', file=sys.stderr )
+        child = [sys.executable, os.path.realpath( __file__ ), '--child', result_file, '--']
+        subprocess.run( child + diff_args, check=True )
+
+        with open( result_file ) as inf:
+             result = json.load( inf )
+        os.remove( result_file )
+
+        result['label'] = options['label']
+        result['people'] = size
+        result['edit-rate'] = options['edit-rate']
+        result['diff-options'] = options['diff-options']
+        result['date'] = time.strftime( '%Y-%m-%d %H:%M:%S' )
+
+        with open( options['results'], 'a' ) as outf:
+             outf.write( json.dumps( result ) + '\n' )
+
+        show_result( result )
+
+
+def show_result( result ):
+    line = str(result['people']) + ' people:'
+    line += ' wall ' + '%.2f' % result['wall']
+    for phase in result['phases']:
+        line += ' ' + phase + ' ' + '%.2f' % result['phases'][phase]
+    line += ' memory ' + str(result['peak-memory'])
+    print( line )
+
+
+def read_results( file_name ):
+    # the last result for each case
+    # return [(people, edit-rate, options)] = result
+    results = dict()
+    with open( file_name ) as inf:
+         for line in inf:
+             if line.strip():
+                result = json.loads( line )
+                case = (result['people'], result['edit-rate'], ' '.join( result['diff-options'] ))
+                results[case] = result
+    return results
+
+
+def compare_results( file1, file2 ):
+    # ratio of new to old, larger than 1 means slower
+    old = read_results( file1 )
+    new = read_results( file2 )
+    for case in sorted( old ):
+        if case in new:
+           line = str(case[0]) + ' people ' + case[2] + ':'
+           line += ' wall ' + '%.2f' % ( new[case]['wall'] / max( old[case]['wall'], 0.001 ) )
+           for phase in old[case]['phases']:
+               if phase in new[case]['phases']:
+                  ratio = new[case]['phases'][phase] / max( old[case]['phases'][phase], 0.001 )
+                  line += ' ' + phase + ' ' + '%.2f' % ratio
+           ratio = new[case]['peak-memory'] / max( old[case]['peak-memory'], 1 )
+           line += ' memory ' + '%.2f' % ratio
+           print( line )
+
+
+options = get_program_options()
+
+if options['child']:
+   run_child( options['child'], options['diff-options'] )
+elif options['compare']:
+   compare_results( options['compare'][0], options['compare'][1] )
+else:
+   run_benchmark( options )
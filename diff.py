@@ -3,20 +3,54 @@
 """
 Compare two gedcom trees.
 Arguments: tree1file  person1id   tree2file  person2id
+       or: --batch=manifest  tree1file  person1id
+       or: --serve=address
+       or: import it and use a Comparator, with trees already parsed
 
 Options: (see the documentation)
 
 --libpath (default '.')
---format (currently only text output)
+--format (default 'text')
+--output (default standard output)
 --iditem  (default 'xref')
+--match-all
+--jobs (default 1)
+--cache-dir (default none)
+--cache-size (default 20)
+--lazy
+--compact
+--baseline (default none)
+--checkpoint (default none)
+--checkpoint-interval (default 60)
+--resume
+--batch (default none)
+--report-dir (default '.')
+--serve (default none)
+--stats
+--stats-file (default none)
+--profile (default none)
+--traversal (default 'depth')
+--scope (default 'all')
+--generations-up (default none)
+--generations-down (default none)
+--time-limit (default none)
+--max-compared (default none)
+--matcher (default 'greedy')
 --person-name-diff
 --person-date-diff
 --person-place-diff
+--place-parts
 --report-name-diff
 --report-date-diff
+--details
+--sweep-name-diff (default none)
+--sweep-date-diff (default none)
+--sweep-place-diff (default none)
+--both-directions
 
 A person (child,partner,parent) which gets added in tree2 is not deteched,
-in order to do that run the program again reversing the order of the trees.
+in order to do that run the program again reversing the order of the trees,
+or use --both-directions.
 
 This code is released under the MIT License: https://opensource.org/licenses/MIT
 Copyright (c) 2021 John A. Andrea
@@ -26,8 +60,37 @@ import sys
 import os
 import re
 import difflib
+import collections
 import argparse
+import json
+import csv
+import time
+import contextlib
+import cProfile
+import xml.sax.saxutils
 import importlib.util
+import collections.abc
+import mmap
+import array
+import hashlib
+import pickle
+import multiprocessing
+import concurrent.futures
+import io
+import stat
+import traceback
+import socketserver
+import http.server
+import signal
+import copy
+import threading
+import itertools
+
+# only needed for the optimal matcher
+try:
+   import numpy
+except ImportError:
+   numpy = None
 
 
 show_debug = False
@@ -36,8 +99,21 @@ show_debug = False
 life_events = ['birt', 'deat']
 # maybe add baptism. christening
 
+# for the detail differences of matched people, life events first
+detail_events = life_events + ['bapm', 'chr', 'buri', 'crem']
+event_names = {'birt':'Birth', 'deat':'Death', 'bapm':'Baptism', 'chr':'Christening',
+               'buri':'Burial', 'crem':'Cremation'}
+
+# most recently used name and place comparisons to keep
+name_cache_size = 200000
+place_cache_size = 200000
+
+# places kept in the table before a Comparator starts it again
+place_table_size = 500000
+
 def get_version():
-    return '0.2.4'
+    # also part of the cache key, so change it when the cached data changes
+    return '0.2.6'
 
 
 def load_my_module( module_name, relative_path ):
@@ -68,20 +144,134 @@ def load_my_module( module_name, relative_path ):
     return my_module
 
 
-def get_program_options():
+def add_phase_time( state, name, wall, cpu ):
+    # add to a phase which started at the given times
+    if name not in state.phase_times:
+       state.phase_times[name] = [0.0, 0.0]
+    state.phase_times[name][0] += time.perf_counter() - wall
+    state.phase_times[name][1] += time.process_time() - cpu
+
+
+@contextlib.contextmanager
+def timed_phase( state, name ):
+    if state.collect_stats:
+       wall = time.perf_counter()
+       cpu = time.process_time()
+       yield
+       add_phase_time( state, name, wall, cpu )
+    else:
+       yield
+
+
+def show_message( state, *values ):
+    # a problem or warning, on standard error or kept for a library comparison
+    if state.messages is None:
+       print( *values, file=sys.stderr )
+    else:
+       state.messages.append( ' '.join( [str( value ) for value in values] ) )
+
+
+def show_stats( state ):
+    result = dict()
+    result['phases'] = dict()
+    for name in state.phase_times:
+        result['phases'][name] = {'wall':state.phase_times[name][0], 'cpu':state.phase_times[name][1]}
+    result['counters'] = dict( state.counters )
+
+    if state.options['stats'] == '-':
+       print( 'Phase times (seconds, wall cpu)', file=sys.stderr )
+       for name in state.phase_times:
+           print( '  %-14s %10.3f %10.3f' % (name, state.phase_times[name][0], state.phase_times[name][1]), file=sys.stderr )
+       print( 'Counts', file=sys.stderr )
+       for name in sorted( state.counters ):
+           print( '  %-28s %12d' % (name, state.counters[name]), file=sys.stderr )
+    else:
+       with open( state.options['stats'], 'w' ) as outf:
+            json.dump( result, outf, indent=1 )
+
+
+def add_phase_times( state, more ):
+    # from a worker process, so the wall times of workers at the same time are added together
+    for name in more:
+        if name not in state.phase_times:
+           state.phase_times[name] = [0.0, 0.0]
+        state.phase_times[name][0] += more[name][0]
+        state.phase_times[name][1] += more[name][1]
+
+
+def add_counters( state, more ):
+    # from a worker process
+    largest = max( state.counters['largest-match-matrix'], more['largest-match-matrix'] )
+    state.counters.update( more )
+    state.counters['largest-match-matrix'] = largest
+
+
+def get_default_options():
     results = dict()
 
     results['libpath'] = '.'
     results['format'] = 'text'
+    results['output'] = None
     results['iditem'] = 'xref'
+    results['traversal'] = 'depth'
+    results['matcher'] = 'greedy'
 
     # limits on "same person" match
     results['person-name-diff'] = 0.92 # via difflib.SequenceMatcher.ratio
     results['person-date-diff'] = 400 # days
     results['person-place-diff'] = 0.90 # same as name, for life events
+    results['place-parts'] = False
     results['report-name-diff'] = 0.99 # tighter than the same person matching
     results['report-date-diff'] = 14 # days
 
+    # also report small differences between matched people
+    results['details'] = False
+
+    # lists of the same person limits, to count the findings of each combination
+    results['sweep-name-diff'] = None
+    results['sweep-date-diff'] = None
+    results['sweep-place-diff'] = None
+
+    results['both-directions'] = False
+    results['match-all'] = False
+    results['jobs'] = 1
+
+    # limits on the walk through the trees
+    results['scope'] = 'all'
+    results['generations-up'] = None
+    results['generations-down'] = None
+    results['time-limit'] = None # seconds
+    results['max-compared'] = None # people
+
+    # timing and counts, to standard error ('-') or a json file
+    results['stats'] = None
+    results['profile'] = None
+
+    # parsed trees are saved here, if given
+    results['cache-dir'] = None
+    results['cache-size'] = 20 # files
+
+    # read only the people and families reached, without the library
+    results['lazy'] = False
+
+    # keep the trees as arrays rather than the parsed data
+    results['compact'] = False
+
+    # results of a previous run, to compare only the changed parts of the trees
+    results['baseline'] = None
+
+    # state of a long comparison saved from time to time, to continue if stopped
+    results['checkpoint'] = None
+    results['checkpoint-interval'] = 60 # seconds
+    results['resume'] = False
+
+    # compare the first tree to each of the trees listed in a file
+    results['batch'] = None
+    results['report-dir'] = '.'
+
+    # answer comparison requests, keeping the trees loaded
+    results['serve'] = None
+
     # not yet used
     ## limits on "same event" match for general events (incl. marriage)
     #results['event-place-diff'] = 0.90
@@ -92,6 +282,12 @@ def get_program_options():
     results['file2'] = None
     results['id2'] = None
 
+    return results
+
+
+def get_program_options():
+    results = get_default_options()
+
     arg_help = 'Display gedcom differences.'
     parser = argparse.ArgumentParser( description=arg_help )
 
@@ -99,15 +295,26 @@ def get_program_options():
     arg_help = 'Location of the gedcom library. Default is current directory.'
     parser.add_argument( '--libpath', default=results['libpath'], type=str, help=arg_help )
 
-    # not yet used
-    #formats = [results['format']]
-    #arg_help = 'Output format. One of: ' + str(formats) + ', Default: ' + results['format']
-    #parser.add_argument( '--format', default=results['format'], choices=formats, type=str, help=arg_help )
+    formats = [results['format'], 'jsonl', 'graphml', 'd3']
+    arg_help = 'Output format. One of: ' + str(formats) + ', Default: ' + results['format']
+    parser.add_argument( '--format', default=results['format'], choices=formats, type=str, help=arg_help )
+
+    arg_help = 'Write the report to this file. Default is standard output.'
+    parser.add_argument( '--output', default=results['output'], type=str, help=arg_help )
 
     arg_help = 'How to find the person. Default is the gedcom id "xref".'
     arg_help += ' Othewise choose "exid", "refnum", etc.'
     parser.add_argument( '--iditem', default=results['iditem'], type=str, help=arg_help )
 
+    traversals = ['depth','breadth']
+    arg_help = 'Order of walking the trees. One of: ' + str(traversals) + '. Default: ' + results['traversal']
+    parser.add_argument( '--traversal', default=results['traversal'], choices=traversals, type=str, help=arg_help )
+
+    matcher_names = ['greedy','sorted','optimal']
+    arg_help = 'Method of pairing children and partners. One of: ' + str(matcher_names) + '.'
+    arg_help += ' Optimal requires numpy. Default: ' + results['matcher']
+    parser.add_argument( '--matcher', default=results['matcher'], choices=matcher_names, type=str, help=arg_help )
+
     arg_help = 'Less than this name diff is a different person. Via difflib.SequenceMatcher.ratio'
     arg_help += ' (0=very different, 1=exact same). Default ' + str(results['person-name-diff'])
     parser.add_argument( '--person-name-diff', default=results['person-name-diff'], type=float, help=arg_help )
@@ -118,7 +325,11 @@ def get_program_options():
 
     arg_help = 'Less that this name diff for a life event place is a different person.'
     arg_help += ' Same units as name. Default ' + str(results['person-place-diff'])
-    parser.add_argument( '--person-place-diff', default=results['person-place-diff'], type=int, help=arg_help )
+    parser.add_argument( '--person-place-diff', default=results['person-place-diff'], type=float, help=arg_help )
+
+    arg_help = 'Compare places by their comma separated parts, from the last,'
+    arg_help += ' ignoring the extra first parts of the more detailed place.'
+    parser.add_argument( '--place-parts', default=results['place-parts'], action='store_true', help=arg_help )
 
     arg_help = 'Same person, report small differences in name and place.'
     arg_help += ' Same units as person-name. Default ' + str(results['report-name-diff'])
@@ -128,83 +339,316 @@ def get_program_options():
     arg_help += ' Default ' + str(results['report-date-diff'])
     parser.add_argument( '--report-date-diff', default=results['report-date-diff'], type=int, help=arg_help )
 
+    arg_help = 'After comparing the trees, also report the differences in name, event dates and places,'
+    arg_help += ' and events in only one tree, of each pair of matched people.'
+    parser.add_argument( '--details', default=results['details'], action='store_true', help=arg_help )
+
+    arg_help = 'Comma separated values of person-name-diff to try. With any of the sweep options'
+    arg_help += ' the trees are compared for each combination of the values, and a csv line of'
+    arg_help += ' the number of each kind of finding is written for each, rather than the report.'
+    parser.add_argument( '--sweep-name-diff', default=results['sweep-name-diff'], type=str, help=arg_help )
+
+    arg_help = 'Comma separated values of person-date-diff to try.'
+    parser.add_argument( '--sweep-date-diff', default=results['sweep-date-diff'], type=str, help=arg_help )
+
+    arg_help = 'Comma separated values of person-place-diff to try.'
+    parser.add_argument( '--sweep-place-diff', default=results['sweep-place-diff'], type=str, help=arg_help )
+
+    arg_help = 'Also compare the second tree against the first, in the same run.'
+    parser.add_argument( '--both-directions', default=results['both-directions'], action='store_true', help=arg_help )
+
+    arg_help = 'After comparing from the starting people, also compare everyone else'
+    arg_help += ' by matching similar people across the whole trees.'
+    parser.add_argument( '--match-all', default=results['match-all'], action='store_true', help=arg_help )
+
+    arg_help = 'Number of processes for comparing separate branches. Default ' + str(results['jobs'])
+    parser.add_argument( '--jobs', default=results['jobs'], type=int, help=arg_help )
+
+    arg_help = 'Which relatives of the starting people to compare: all, only their ancestors,'
+    arg_help += ' or only their descendants. Default ' + results['scope']
+    parser.add_argument( '--scope', default=results['scope'], choices=['all','ancestors','descendants'], help=arg_help )
+
+    arg_help = 'Compare no more than this many generations above the starting people.'
+    parser.add_argument( '--generations-up', default=results['generations-up'], type=int, help=arg_help )
+
+    arg_help = 'Compare no more than this many generations below the starting people.'
+    parser.add_argument( '--generations-down', default=results['generations-down'], type=int, help=arg_help )
+
+    arg_help = 'Stop comparing after this many seconds, reporting the people not yet compared.'
+    parser.add_argument( '--time-limit', default=results['time-limit'], type=float, help=arg_help )
+
+    arg_help = 'Stop comparing after this many people, reporting the people not yet compared.'
+    parser.add_argument( '--max-compared', default=results['max-compared'], type=int, help=arg_help )
+
+    arg_help = 'Directory in which to keep parsed trees for faster re-use. Default is no caching.'
+    parser.add_argument( '--cache-dir', default=results['cache-dir'], type=str, help=arg_help )
+
+    arg_help = 'Maximum number of parsed trees kept in the cache directory,'
+    arg_help += ' least recently used are removed. Default ' + str(results['cache-size'])
+    parser.add_argument( '--cache-size', default=results['cache-size'], type=int, help=arg_help )
+
+    arg_help = 'Read only the parts of the files used in the comparison, as they are needed.'
+    arg_help += ' Faster to start and uses less memory for large files, but the dates are read more simply'
+    arg_help += ' than by the gedcom library. The iditem must be xref.'
+    parser.add_argument( '--lazy', default=results['lazy'], action='store_true', help=arg_help )
+
+    arg_help = 'Once loaded keep the trees as arrays of numbered people and families,'
+    arg_help += ' with only the details used, to reduce the memory needed for large trees.'
+    parser.add_argument( '--compact', default=results['compact'], action='store_true', help=arg_help )
+
+    arg_help = 'Re-use the comparisons of unchanged people from this file, made by a previous run.'
+    arg_help += ' The file is then updated for the next run.'
+    parser.add_argument( '--baseline', default=results['baseline'], type=str, help=arg_help )
+
+    arg_help = 'Save the state of the comparison to this file from time to time, and when interrupted,'
+    arg_help += ' so that it can be continued with --resume. The file is removed when the comparison ends.'
+    parser.add_argument( '--checkpoint', default=results['checkpoint'], type=str, help=arg_help )
+
+    arg_help = 'Seconds between checkpoints. Default ' + str(results['checkpoint-interval'])
+    parser.add_argument( '--checkpoint-interval', default=results['checkpoint-interval'], type=float, help=arg_help )
+
+    arg_help = 'Continue from the checkpoint file, if it exists. The report is the same as from an uninterrupted run.'
+    parser.add_argument( '--resume', default=results['resume'], action='store_true', help=arg_help )
+
+    arg_help = 'Compare the first tree to each of the trees in this csv file of lines: file,id.'
+    arg_help += ' Then file2 and id2 are not given. A report for each is written to the report directory'
+    arg_help += ' and a summary to the output. With jobs the files are compared at the same time.'
+    parser.add_argument( '--batch', default=results['batch'], type=str, help=arg_help )
+
+    arg_help = 'Existing directory for the reports of a batch. Default ' + results['report-dir']
+    parser.add_argument( '--report-dir', default=results['report-dir'], type=str, help=arg_help )
+
+    arg_help = 'Keep running, answering comparison requests made by http to this address,'
+    arg_help += ' either host:port or the path of a unix socket. The files are then given in the requests.'
+    parser.add_argument( '--serve', default=results['serve'], type=str, help=arg_help )
+
+    arg_help = 'At the end show the time of each phase and counts of the work done, to standard error.'
+    parser.add_argument( '--stats', default=False, action='store_true', help=arg_help )
+
+    arg_help = 'Write the stats to this file as json, rather than show them.'
+    parser.add_argument( '--stats-file', default=None, type=str, help=arg_help )
+
+    arg_help = 'Write python profiler data of the whole run to this file.'
+    parser.add_argument( '--profile', default=results['profile'], type=str, help=arg_help )
+
     arg_help = 'Show version then exit.'
     parser.add_argument( '--version', action='version', version=get_version() )
 
-    parser.add_argument('file1', type=argparse.FileType('r') )
-    parser.add_argument('id1', type=str )
-    parser.add_argument('file2', type=argparse.FileType('r') )
-    parser.add_argument('id2', type=str )
+    parser.add_argument('file1', nargs='?', type=argparse.FileType('r') )
+    parser.add_argument('id1', nargs='?', type=str )
+    parser.add_argument('file2', nargs='?', type=argparse.FileType('r') )
+    parser.add_argument('id2', nargs='?', type=str )
 
     args = parser.parse_args()
 
+    if args.serve:
+       if args.file1 or args.id1 or args.file2 or args.id2:
+          parser.error( 'files are given in the requests with --serve' )
+    elif args.file1 is None or args.id1 is None:
+       parser.error( 'the following arguments are required: file1, id1' )
+    elif args.batch:
+       if args.file2 or args.id2:
+          parser.error( 'file2 and id2 are not given with --batch' )
+    else:
+       if args.file2 is None or args.id2 is None:
+          parser.error( 'the following arguments are required: file2, id2' )
+
     results['libpath'] = args.libpath
-    #results['format'] = args.format.lower()
+    results['format'] = args.format.lower()
+    results['output'] = args.output
     results['iditem'] = args.iditem.lower()
-    results['file1'] = args.file1.name
+    results['traversal'] = args.traversal
+    results['matcher'] = args.matcher
+    results['file1'] = None
+    if args.file1:
+       results['file1'] = args.file1.name
     results['id1'] = args.id1
-    results['file2'] = args.file2.name
+    results['file2'] = None
+    if args.file2:
+       results['file2'] = args.file2.name
     results['id2'] = args.id2
 
     results['person-name-diff'] = args.person_name_diff
     results['person-date-diff'] = args.person_date_diff
     results['person-place-diff'] = args.person_place_diff
+    results['place-parts'] = args.place_parts
 
     results['report-name-diff'] = args.report_name_diff
     results['report-date-diff'] = args.report_date_diff
+    results['details'] = args.details
+
+    for item in ['sweep-name-diff','sweep-date-diff','sweep-place-diff']:
+        value = getattr( args, item.replace( '-', '_' ) )
+        if value is not None:
+           wanted_type = float
+           if item == 'sweep-date-diff':
+              wanted_type = int
+           try:
+              value = [wanted_type( x ) for x in value.split( ',' )]
+           except ValueError:
+              print( item, 'must be a comma separated list of', wanted_type, file=sys.stderr )
+              sys.exit(1)
+        results[item] = value
+
+    results['both-directions'] = args.both_directions
+    results['match-all'] = args.match_all
+    results['jobs'] = args.jobs
+
+    results['scope'] = args.scope
+    results['generations-up'] = args.generations_up
+    results['generations-down'] = args.generations_down
+    results['time-limit'] = args.time_limit
+    results['max-compared'] = args.max_compared
+
+    results['stats'] = None
+    if args.stats:
+       results['stats'] = '-'
+    if args.stats_file:
+       results['stats'] = args.stats_file
+    results['profile'] = args.profile
+
+    results['cache-dir'] = args.cache_dir
+    results['cache-size'] = args.cache_size
+    results['lazy'] = args.lazy
+    results['compact'] = args.compact
+    results['baseline'] = args.baseline
+    results['checkpoint'] = args.checkpoint
+    results['checkpoint-interval'] = args.checkpoint_interval
+    results['resume'] = args.resume
+    results['batch'] = args.batch
+    results['report-dir'] = args.report_dir
+    results['serve'] = args.serve
 
     return results
 
 
-def check_config( start_ok ):
+def check_config( state, start_ok ):
     ok = start_ok
 
     def check_val( start_ok, wanted_type, maximum, x_name, x ):
         ok = start_ok
         if isinstance( x, wanted_type ):
            if x < 0:
-              print( x_name, 'cannot be less than zero', file=sys.stderr )
+              show_message( state, x_name, 'cannot be less than zero' )
               ok = False
            if maximum and x > maximum:
-              print( x_name, 'cannot be greater than', maximum, file=sys.stderr )
+              show_message( state, x_name, 'cannot be greater than', maximum )
               ok = False
         else:
-           print( x_name, 'must be a', wanted_type, file=sys.stderr )
+           show_message( state, x_name, 'must be a', wanted_type )
            ok = False
         return ok
 
     for item in ['person-name-diff','person-place-diff']:
-        ok = check_val( ok, float, 1.0, item, options[item] )
+        ok = check_val( ok, float, 1.0, item, state.options[item] )
     for item in ['person-date-diff']:
-        ok = check_val( ok, int,  None, item, options[item] )
+        ok = check_val( ok, int,  None, item, state.options[item] )
+    ok = check_val( ok, float, 1.0, 'report-name-diff', state.options['report-name-diff'] )
+    ok = check_val( ok, int,  None, 'report-date-diff', state.options['report-date-diff'] )
+
+    for item in ['name','date','place']:
+        values = state.options['sweep-' + item + '-diff']
+        if values is not None:
+           maximum = None if item == 'date' else 1.0
+           for x in values:
+               ok = check_val( ok, type( x ), maximum, 'sweep-' + item + '-diff', x )
+
+    if is_sweep( state ):
+       for item in ['batch', 'baseline', 'checkpoint']:
+           if state.options[item]:
+              show_message( state, item, 'cannot be used with a sweep' )
+              ok = False
+
+    for item in ['generations-up','generations-down','max-compared']:
+        if state.options[item] is not None:
+           ok = check_val( ok, int, None, item, state.options[item] )
+    if state.options['time-limit'] is not None:
+       ok = check_val( ok, float, None, 'time-limit', state.options['time-limit'] )
+
+    if state.options['jobs'] < 1:
+       show_message( state, 'jobs cannot be less than one' )
+       ok = False
+    if state.options['jobs'] > 1 and not state.options['batch']:
+       if state.options['time-limit'] is not None or state.options['max-compared'] is not None:
+          show_message( state, 'The time and compared limits require a single job' )
+          ok = False
+    if state.options['jobs'] > 1:
+       if state.options['traversal'] != 'depth' and not state.options['batch']:
+          show_message( state, 'Multiple jobs requires the depth traversal' )
+          ok = False
+       if 'fork' not in multiprocessing.get_all_start_methods():
+          show_message( state, 'Multiple jobs are not available on this system' )
+          ok = False
+
+    if state.options['lazy'] and state.options['iditem'] != 'xref':
+       show_message( state, 'The lazy reading requires the xref iditem' )
+       ok = False
+
+    if state.options['lazy'] and state.options['compact']:
+       show_message( state, 'The lazy reading and compact trees cannot be used together' )
+       ok = False
+
+    if state.options['details'] and state.options['compact']:
+       show_message( state, 'The details require the full trees, they cannot be used with compact' )
+       ok = False
+
+    if state.options['serve']:
+       for item in ['batch', 'baseline', 'compact', 'checkpoint', 'sweep-name-diff', 'sweep-date-diff', 'sweep-place-diff']:
+           if state.options[item]:
+              show_message( state, item, 'cannot be used with serve' )
+              ok = False
+
+    if state.options['checkpoint']:
+       if state.options['batch']:
+          show_message( state, 'A checkpoint cannot be used with a batch' )
+          ok = False
+       if state.options['jobs'] > 1:
+          show_message( state, 'A checkpoint requires a single job' )
+          ok = False
+       if state.options['checkpoint-interval'] <= 0:
+          show_message( state, 'checkpoint-interval must be greater than zero' )
+          ok = False
+    elif state.options['resume']:
+       show_message( state, 'Resume requires the checkpoint file' )
+       ok = False
+
+    if state.options['batch']:
+       if state.options['baseline']:
+          show_message( state, 'A baseline cannot be used with a batch' )
+          ok = False
+       if not os.path.isdir( state.options['report-dir'] ):
+          show_message( state, 'Report directory does not exist:', state.options['report-dir'] )
+          ok = False
+
+    if state.options['matcher'] == 'optimal' and numpy is None:
+       show_message( state, 'The optimal matcher requires the numpy module' )
+       ok = False
 
     return ok
 
 
+def day_count( date ):
+    # expecting a date as a string yyyymmdd
+    # return an approximate count of days, only for comparisons
+    # yyyymmdd
+    # 01234567
+    return int(date[0:4]) * 365 + int(date[4:6]) * 30 + int(date[6:8])
+
+
 def days_between( d1, d2 ):
     # expecting two dates as strings yyyymmdd
     # return the approximate number of days between
     # this is only for approximate comparisons, not date manipulations
     # Assuming dates are C.E. Gregorian
+    return abs( day_count( d1 ) - day_count( d2 ) )
 
-    def extract_parts( date ):
-        # yyyymmdd
-        # 01234567
-        return [ date[0:4], date[4:6], date[6:8] ]
-
-    def total_days( date ):
-        # [0]=year [1]=month [2]=day
-        return int(date[0]) * 365 + int(date[1]) * 30 + int(date[2])
 
-    days1 = total_days( extract_parts( d1 ) )
-    days2 = total_days( extract_parts( d2 ) )
+def get_name( state, t, p ):
+    if isinstance( state.trees[t], CompactTree ):
+       return state.indexes[t][p].name
 
-    return abs( days1 - days2 )
-
-
-def get_name( t, p ):
-    result = trees[t][ikey][p]['name'][0]['value']
-    if readgedcom.UNKNOWN_NAME in result:
+    result = state.trees[t][state.ikey][p]['name'][0]['value']
+    if state.readgedcom.UNKNOWN_NAME in result:
        result = 'unknown'
     else:
        # remove any suffix after the end slash
@@ -212,406 +656,3081 @@ def get_name( t, p ):
     return result
 
 
-def get_best_event_id( t, p, event_name ):
+def get_surname( state, t, p ):
+    # the part of the name between the slashes, or empty
+    result = ''
+    value = state.trees[t][state.ikey][p]['name'][0]['value']
+    if state.readgedcom.UNKNOWN_NAME not in value:
+       m = re.search( r'/([^/]*)/', value )
+       if m:
+          result = m.group(1).strip()
+    return result
+
+
+def soundex( name ):
+    # the american soundex code, so that similar sounding names group together
+    codes = {'b':'1', 'f':'1', 'p':'1', 'v':'1',
+             'c':'2', 'g':'2', 'j':'2', 'k':'2', 'q':'2', 's':'2', 'x':'2', 'z':'2',
+             'd':'3', 't':'3', 'l':'4', 'm':'5', 'n':'5', 'r':'6'}
+
+    letters = [c for c in name.lower() if c.isalpha()]
+    if not letters:
+       return ''
+
+    result = letters[0].upper()
+    previous = codes.get( letters[0], '' )
+    for c in letters[1:]:
+        code = codes.get( c, '' )
+        if code and code != previous:
+           result += code
+           if len( result ) == 4:
+              break
+        # h and w don't separate letters with the same code
+        if c not in 'hw':
+           previous = code
+
+    return ( result + '000' )[0:4]
+
+
+def get_partner_name( state, t, p ):
+    # the partner in a family might not be known
+    result = 'unknown'
+    if p is not None:
+       result = get_name( state, t, p )
+    return result
+
+
+def get_best_event_id( state, t, p, event_name ):
     best = None
-    if event_name in trees[t][ikey][p]['best-events']:
-       best = trees[t][ikey][p]['best-events'][event_name]
+    if event_name in state.trees[t][state.ikey][p]['best-events']:
+       best = state.trees[t][state.ikey][p]['best-events'][event_name]
     return best
 
 
-def get_event_place( t, p, event_name ):
+def get_event_place( state, t, p, event_name ):
     result = None
-    best = get_best_event_id( t, p, event_name )
+    best = get_best_event_id( state, t, p, event_name )
     if best is not None:
-       if 'plac' in trees[t][ikey][p][event_name][best]:
-          result = trees[t][ikey][p][event_name][best]['plac']
+       if 'plac' in state.trees[t][state.ikey][p][event_name][best]:
+          result = state.trees[t][state.ikey][p][event_name][best]['plac']
     return result
 
 
-def get_full_date( t, p, event_name ):
+def get_full_date( state, t, p, event_name ):
     # return the yyyymmdd value for the person's dated event, or None
     result = None
-    best = get_best_event_id( t, p, event_name )
+    best = get_best_event_id( state, t, p, event_name )
     if best is not None:
-       if trees[t][ikey][p][event_name][best]['date']['is_known']:
+       if state.trees[t][state.ikey][p][event_name][best]['date']['is_known']:
           # get the minimum date if its a range. if not a range min and max are equal
-          result = trees[t][ikey][p][event_name][best]['date']['min']['value']
+          result = state.trees[t][state.ikey][p][event_name][best]['date']['min']['value']
     return result
 
 
-def get_a_date( t, p, event_name ):
+def get_a_date( state, t, p, event_name ):
     # return the date as given in the input file (or an empty string),
     # which might contain before/after/etc or be a range
     # not appropriate for comparison
     result = ''
-    best = get_best_event_id( t, p, event_name )
+    best = get_best_event_id( state, t, p, event_name )
     if best is not None:
-       if trees[t][ikey][p][event_name][best]['date']['is_known']:
-          result = trees[t][ikey][p][event_name][best]['date']['in']
+       if state.trees[t][state.ikey][p][event_name][best]['date']['is_known']:
+          result = state.trees[t][state.ikey][p][event_name][best]['date']['in']
     return result
 
 
-def get_dates( t, p ):
+def get_dates( state, t, p ):
     # for display purposes, not for comparison
-    return [ get_a_date(t, p, 'birt'), get_a_date(t, p, 'deat') ]
+    if isinstance( state.trees[t], CompactTree ):
+       return list( state.trees[t].dates[state.trees[t].person_ids[p]] )
+    return [ get_a_date(state, t, p, 'birt'), get_a_date(state, t, p, 'deat') ]
 
 
-def show_indi( t, p ):
+def show_indi( state, t, p ):
     # show an person's important details
-    dates = get_dates(t,p)
-    return get_name(t,p) + ' (' + dates[0] + '-' + dates[1] + ')'
+    dates = get_dates(state,t,p)
+    return get_name(state,t,p) + ' (' + dates[0] + '-' + dates[1] + ')'
+
+
+def get_parent_family( state, t, p ):
+    # the family in which the person is a child, or None
+    if isinstance( state.trees[t], CompactTree ):
+       return state.trees[t].get_family( state.trees[t].famc[state.trees[t].person_ids[p]] )
+
+    result = None
+    if 'famc' in state.trees[t][state.ikey][p]:
+       result = state.trees[t][state.ikey][p]['famc'][0]
+    return result
+
+
+def get_partner_families( state, t, p ):
+    # the families in which the person is a partner
+    if isinstance( state.trees[t], CompactTree ):
+       i = state.trees[t].person_ids[p]
+       return state.trees[t].get_families( state.trees[t].fams, state.trees[t].fams_start, i )
+
+    result = []
+    if 'fams' in state.trees[t][state.ikey][p]:
+       result = state.trees[t][state.ikey][p]['fams']
+    return result
+
+
+def get_family_partner( state, t, f, partner ):
+    # the wife or husb of the family, or None
+    if isinstance( state.trees[t], CompactTree ):
+       i = state.trees[t].family_ids[f]
+       return state.trees[t].get_person( state.trees[t].partners[partner][i] )
+
+    result = None
+    if partner in state.trees[t][state.fkey][f]:
+       result = state.trees[t][state.fkey][f][partner][0]
+    return result
+
 
+def get_children( state, t, f ):
+    if isinstance( state.trees[t], CompactTree ):
+       i = state.trees[t].family_ids[f]
+       return state.trees[t].get_people( state.trees[t].chil, state.trees[t].chil_start, i )
+    return state.trees[t][state.fkey][f]['chil']
 
-def get_other_partner( t, p, f ):
+
+def get_other_partner( state, t, p, f ):
     # in any given family, return the partner of the given person
     result = None
     for partner in ['wife','husb']:
-        if partner in trees[t][fkey][f]:
-           partner_id = trees[t][fkey][f][partner][0]
-           if partner_id != p:
-              result = partner_id
+        partner_id = get_family_partner( state, t, f, partner )
+        if partner_id is not None and partner_id != p:
+           result = partner_id
     return result
 
 
-def list_all_partners( t, p ):
+def list_all_partners( state, t, p ):
     # for the given person in all the families in which they are a partner
     # return   [family-id] = the-other-partner-id
     # though partnerid might be unknown i.e. None
     result = dict()
-    if 'fams' in trees[t][ikey][p]:
-       for fam in trees[t][ikey][p]['fams']:
-           result[fam] = get_other_partner( t, p, fam )
+    for fam in get_partner_families( state, t, p ):
+        result[fam] = get_other_partner( state, t, p, fam )
+    return result
+
+
+class PersonFeatures:
+    # the values used in the same person tests,
+    # extracted once so the comparisons don't have to dig through the tree
+    __slots__ = ['name', 'surname_code', 'days', 'places']
+
+    def __init__( self, state, t, p ):
+        self.name = get_name( state, t, p )
+        self.surname_code = soundex( get_surname( state, t, p ) )
+
+        # in the same order as the life events
+        days = []
+        places = []
+        for e in life_events:
+            date = get_full_date( state, t, p, e )
+            if date:
+               days.append( day_count( date ) )
+            else:
+               days.append( None )
+            places.append( get_place_id( state, get_event_place( state, t, p, e ) ) )
+        self.days = tuple( days )
+        self.places = tuple( places )
+
+
+def build_person_index( state, t ):
+    # return [indi-xref] = features, for every person in the tree
+    result = dict()
+    for p in state.trees[t][state.ikey]:
+        result[p] = PersonFeatures( state, t, p )
+    return result
+
+
+class CompactTree:
+    # the relations of a tree as arrays of numbered people and families,
+    # and only the details of each person used in the report, for --compact
+    # a list of relatives of number i is from list[start[i]] to before list[start[i+1]]
+
+    def __init__( self, state, t ):
+        self.people = []
+        self.person_ids = dict()
+        self.families = []
+        self.family_ids = dict()
+
+        for p in state.trees[t][state.ikey]:
+            self.get_person_id( p )
+        for f in state.trees[t][state.fkey]:
+            self.get_family_id( f )
+
+        # -1 when none
+        self.famc = array.array( 'i' )
+        self.fams = array.array( 'i' )
+        self.fams_start = array.array( 'i', [0] )
+        self.dates = []
+        for p in state.trees[t][state.ikey]:
+            self.famc.append( self.get_family_id( get_parent_family( state, t, p ) ) )
+            for f in get_partner_families( state, t, p ):
+                self.fams.append( self.get_family_id( f ) )
+            self.fams_start.append( len( self.fams ) )
+            self.dates.append( tuple( [sys.intern( d ) for d in get_dates( state, t, p )] ) )
+
+        self.partners = {'wife':array.array( 'i' ), 'husb':array.array( 'i' )}
+        self.chil = array.array( 'i' )
+        self.chil_start = array.array( 'i', [0] )
+        for f in state.trees[t][state.fkey]:
+            for partner in self.partners:
+                self.partners[partner].append( self.get_person_id( get_family_partner( state, t, f, partner ) ) )
+            for c in get_children( state, t, f ):
+                self.chil.append( self.get_person_id( c ) )
+            self.chil_start.append( len( self.chil ) )
+
+        # also links to missing records, as families without members
+        while len( self.fams_start ) <= len( self.people ):
+            self.famc.append( -1 )
+            self.fams_start.append( len( self.fams ) )
+            self.dates.append( ('','') )
+        while len( self.chil_start ) <= len( self.families ):
+            for partner in self.partners:
+                self.partners[partner].append( -1 )
+            self.chil_start.append( len( self.chil ) )
+
+    def get_person_id( self, p ):
+        if p is None:
+           return -1
+        if p not in self.person_ids:
+           self.person_ids[p] = len( self.people )
+           self.people.append( p )
+        return self.person_ids[p]
+
+    def get_family_id( self, f ):
+        if f is None:
+           return -1
+        if f not in self.family_ids:
+           self.family_ids[f] = len( self.families )
+           self.families.append( f )
+        return self.family_ids[f]
+
+    def get_person( self, i ):
+        if i < 0:
+           return None
+        return self.people[i]
+
+    def get_family( self, i ):
+        if i < 0:
+           return None
+        return self.families[i]
+
+    def get_people( self, relatives, start, i ):
+        return [self.people[j] for j in relatives[start[i]:start[i+1]]]
+
+    def get_families( self, relatives, start, i ):
+        return [self.families[j] for j in relatives[start[i]:start[i+1]]]
+
+
+def compact_tree( state, t ):
+    # replace the parsed data, which is then released
+    with timed_phase( state, 'compact' ):
+         compact = CompactTree( state, t )
+         # the same names are often repeated, the places are already numbers
+         for features in state.indexes[t].values():
+             features.name = sys.intern( features.name )
+         state.trees[t] = compact
+
+
+def is_parsed_tree( state, t ):
+    return isinstance( state.trees[t], dict ) and state.ikey in state.trees[t]
+
+
+def get_file_hash( file_name ):
+    result = hashlib.sha256()
+    with open( file_name, 'rb' ) as inf:
+         for block in iter( lambda: inf.read( 1024 * 1024 ), b'' ):
+             result.update( block )
+    return result.hexdigest()
+
+
+def get_library_version( state ):
+    result = 'unknown'
+    if hasattr( state.readgedcom, 'get_version' ):
+       result = str( state.readgedcom.get_version() )
+    return result
+
+
+def get_cache_file( state, file_name ):
+    # changes to the file, this program or the library make a new cache entry
+    key = get_file_hash( file_name )
+    key += ' ' + get_version()
+    key += ' ' + get_library_version( state )
+    key = hashlib.sha256( key.encode() ).hexdigest()
+    return os.path.join( state.options['cache-dir'], key + '.pickle' )
+
+
+def read_cache( cache_file ):
+    result = None
+    if os.path.isfile( cache_file ):
+       try:
+          with open( cache_file, 'rb' ) as inf:
+               result = pickle.load( inf )
+          # mark as recently used
+          os.utime( cache_file )
+       except (OSError, EOFError, pickle.UnpicklingError, AttributeError):
+          print( 'Ignoring unreadable cache file', cache_file, file=sys.stderr )
+          result = None
+    return result
+
+
+def write_pickle( file_name, data ):
+    # write to a temporary name first so a reader never sees a partial file
+    temp_file = file_name + '.' + str( os.getpid() ) + '.tmp'
+    with open( temp_file, 'wb' ) as outf:
+         pickle.dump( data, outf, protocol=pickle.HIGHEST_PROTOCOL )
+    os.replace( temp_file, file_name )
+
+
+def write_cache( state, cache_file, data ):
+    write_pickle( cache_file, data )
+
+    # remove the least recently used files beyond the limit,
+    # other processes might be doing the same
+    cached = []
+    for f in os.listdir( state.options['cache-dir'] ):
+        if f.endswith( '.pickle' ):
+           f = os.path.join( state.options['cache-dir'], f )
+           with contextlib.suppress( FileNotFoundError ):
+                cached.append( [os.path.getmtime( f ), f] )
+    cached.sort( reverse=True )
+    for item in cached[state.options['cache-size']:]:
+        with contextlib.suppress( FileNotFoundError ):
+             os.remove( item[1] )
+
+
+month_numbers = {'JAN':1, 'FEB':2, 'MAR':3, 'APR':4, 'MAY':5, 'JUN':6,
+                 'JUL':7, 'AUG':8, 'SEP':9, 'OCT':10, 'NOV':11, 'DEC':12}
+
+leading_digits = re.compile( r'\d+' )
+
+
+def decode_date( text ):
+    # a simpler reading of a gedcom date than the library's, for --lazy
+    # in the same form, with the first date of a range or period as the minimum
+    result = {'in':text, 'is_known':False}
+    day = None
+    month = None
+    for word in text.upper().split():
+        if word in month_numbers:
+           month = month_numbers[word]
+        elif word[0].isdigit():
+           # such as 1750/51
+           number = leading_digits.match( word ).group(0)
+           if len( number ) <= 2 and month is None and day is None:
+              day = int( number )
+           else:
+              result['is_known'] = True
+              result['min'] = {'value':'%04d%02d%02d' % (int( number ), month or 1, day or 1)}
+              break
+    return result
+
+
+def decode_record( state, text, kind ):
+    # only the parts of a record used in the comparison,
+    # in the same form as the library's parsed data
+    record = dict()
+    if kind == 'INDI':
+       record['best-events'] = dict()
+       tags = ['name', 'famc', 'fams']
+    else:
+       record['chil'] = []
+       tags = ['husb', 'wife', 'chil']
+
+    event = None
+    for line in text.splitlines()[1:]:
+        parts = line.split( None, 2 )
+        if len( parts ) < 2:
+           continue
+        level = parts[0]
+        if level not in ['1','2']:
+           continue
+        tag = parts[1].lower()
+        value = ''
+        if len( parts ) > 2:
+           value = parts[2].strip()
+
+        if level == '1':
+           event = None
+           if tag in tags:
+              if tag not in record:
+                 record[tag] = []
+              if tag == 'name':
+                 record[tag].append( {'value':value} )
+              else:
+                 record[tag].append( value )
+           elif kind == 'INDI' and tag in detail_events:
+              event = {'date':{'in':'', 'is_known':False}}
+              if tag not in record:
+                 record[tag] = []
+                 # the first is taken as the best
+                 record['best-events'][tag] = 0
+              record[tag].append( event )
+
+        elif level == '2' and event is not None:
+           if tag == 'date':
+              event['date'] = decode_date( value )
+           elif tag == 'plac':
+              event['plac'] = value
+
+    if kind == 'INDI' and 'name' not in record:
+       record['name'] = [{'value':state.readgedcom.UNKNOWN_NAME}]
+
+    return record
+
+
+class LazyRecords( collections.abc.Mapping ):
+    # [xref] = record, decoded from the file when first used
+
+    def __init__( self, state, data, offsets, kind ):
+        self.state = state
+        self.data = data
+        self.offsets = offsets
+        self.kind = kind
+        self.records = dict()
+
+    def __getitem__( self, xref ):
+        if xref not in self.records:
+           start, end = self.offsets[xref]
+           text = self.data[start:end].decode( 'utf-8', errors='replace' )
+           self.records[xref] = decode_record( self.state, text, self.kind )
+           if self.state.collect_stats:
+              self.state.counters['lazy-records-decoded'] += 1
+        return self.records[xref]
+
+    def __contains__( self, xref ):
+        return xref in self.offsets
+
+    def __iter__( self ):
+        return iter( self.offsets )
+
+    def __len__( self ):
+        return len( self.offsets )
+
+
+class LazyIndex( collections.abc.Mapping ):
+    # [indi-xref] = features, made when first used
+
+    def __init__( self, state, tree ):
+        self.state = state
+        self.tree = tree
+        self.features = dict()
+
+    def __getitem__( self, p ):
+        if p not in self.features:
+           # the trees might have been swapped
+           t = 1
+           if self.state.trees[2] is self.tree:
+              t = 2
+           self.features[p] = PersonFeatures( self.state, t, p )
+        return self.features[p]
+
+    def __contains__( self, p ):
+        return p in self.tree[self.state.ikey]
+
+    def __iter__( self ):
+        return iter( self.tree[self.state.ikey] )
+
+    def __len__( self ):
+        return len( self.tree[self.state.ikey] )
+
+
+def read_lazy( state, file_name ):
+    # find where each person and family is in the file, without decoding them
+    # return the same form as the library's parsed data
+    data = b''
+    with open( file_name, 'rb' ) as inf:
+         if os.path.getsize( file_name ) > 0:
+            # the mapping stays open after the file is closed
+            data = mmap.mmap( inf.fileno(), 0, access=mmap.ACCESS_READ )
+
+    offsets = {'INDI':dict(), 'FAM':dict()}
+    previous = None
+    for m in re.finditer( rb'^[ \t]*0[ \t]+(\S+)(?:[ \t]+(\S+))?', data, re.M ):
+        if previous:
+           offsets[previous[0]][previous[1]] = (previous[2], m.start())
+        previous = None
+        kind = m.group(2)
+        if kind in [b'INDI', b'FAM']:
+           previous = (kind.decode(), m.group(1).decode(), m.start())
+    if previous:
+       offsets[previous[0]][previous[1]] = (previous[2], len( data ))
+
+    result = dict()
+    result[state.ikey] = LazyRecords( state, data, offsets['INDI'], 'INDI' )
+    result[state.fkey] = LazyRecords( state, data, offsets['FAM'], 'FAM' )
+    return result
+
+
+def find_lazy_start( state, t, value ):
+    # the xref as given, or its number as the library allows
+    # return the list of matching xrefs
+    if value in state.trees[t][state.ikey]:
+       return [value]
+    result = []
+    for p in state.trees[t][state.ikey]:
+        if p.strip( '@' ) == value or re.sub( r'\D', '', p ) == value:
+           result.append( p )
+    return result
+
+
+def load_tree( state, t, file_name ):
+    # parse the file, or get it from the cache, along with its index
+    if state.options['lazy']:
+       with timed_phase( state, 'parse' ):
+            state.trees[t] = read_lazy( state, file_name )
+       state.indexes[t] = LazyIndex( state, state.trees[t] )
+       return
+
+    cache_file = None
+    if state.options['cache-dir']:
+       cache_file = get_cache_file( state, file_name )
+       with timed_phase( state, 'cache-read' ):
+            cached = read_cache( cache_file )
+       if cached:
+          if state.collect_stats:
+             state.counters['tree-cache-hits'] += 1
+          state.trees[t] = cached['tree']
+          state.indexes[t] = cached['index']
+          adopt_places( state, state.indexes[t], cached['places'] )
+          return
+       if state.collect_stats:
+          state.counters['tree-cache-misses'] += 1
+
+    # this will cause exit if the input data is very bad
+    with timed_phase( state, 'parse' ):
+         state.trees[t] = state.readgedcom.read_file( file_name )
+
+    index = None
+    if is_parsed_tree( state, t ):
+       # the values used for person matching, computed once
+       with timed_phase( state, 'index' ):
+            index = build_person_index( state, t )
+       if cache_file:
+          write_cache( state, cache_file, {'tree':state.trees[t], 'index':index, 'places':list( state.places.names )} )
+    state.indexes[t] = index
+
+
+def get_record_hashes( state, t ):
+    # return [key][xref] = hash of the parsed record, for the people and families
+    result = dict()
+    for key in [state.ikey, state.fkey]:
+        result[key] = dict()
+        for x in state.trees[t][key]:
+            data = pickle.dumps( state.trees[t][key][x], protocol=pickle.HIGHEST_PROTOCOL )
+            result[key][x] = hashlib.blake2b( data, digest_size=16 ).digest()
+    return result
+
+
+def get_family_members( state, t, f ):
+    result = []
+    for partner in ['husb','wife']:
+        partner_id = get_family_partner( state, t, f, partner )
+        if partner_id is not None:
+           result.append( partner_id )
+    result.extend( get_children( state, t, f ) )
+    return result
+
+
+def get_dirty_records( state, t, hashes, old_hashes ):
+    # the people and families whose comparisons might not be the same as in the baseline,
+    # those which have changed and their immediate relatives
+    # return (people, families)
+    changed = dict()
+    for key in [state.ikey, state.fkey]:
+        changed[key] = set()
+        for x in hashes[key]:
+            if old_hashes[key].get( x ) != hashes[key][x]:
+               changed[key].add( x )
+
+    families = set( changed[state.fkey] )
+    for p in changed[state.ikey]:
+        for key in ['famc','fams']:
+            if key in state.trees[t][state.ikey][p]:
+               families.update( state.trees[t][state.ikey][p][key] )
+
+    people = set( changed[state.ikey] )
+    for f in families:
+        # there might be references to missing families
+        if f in state.trees[t][state.fkey]:
+           people.update( get_family_members( state, t, f ) )
+
+    return people, families
+
+
+def get_baseline_settings( state ):
+    # a baseline made with other settings can't be used
+    result = dict()
+    result['version'] = get_version()
+    for item in ['matcher','person-name-diff','person-date-diff','person-place-diff','place-parts']:
+        result[item] = state.options[item]
+    return result
+
+
+def read_baseline( state, file_name ):
+    result = None
+    if os.path.isfile( file_name ):
+       try:
+          with open( file_name, 'rb' ) as inf:
+               result = pickle.load( inf )
+       except (OSError, EOFError, pickle.UnpicklingError, AttributeError):
+          show_message( state, 'Ignoring unreadable baseline file', file_name )
+          result = None
+    if result and result['settings'] != get_baseline_settings( state ):
+       show_message( state, 'Ignoring baseline made with other settings', file_name )
+       result = None
+    return result
+
+
+def report( kind, relation, p1, p2, role=None, partner=None, other=None, scores=None ):
+    # the work item for a difference found between the trees
+    return ('report', Finding( kind, relation, p1, p2, role, partner, other, scores ))
+
+
+def get_person_scores( state, p1, p2 ):
+    # exact values of the same person tests
+    result = dict()
+    result['name'] = get_name_match_value( state, state.indexes[1][p1].name, state.indexes[2][p2].name )
+    result['date'] = get_life_event_date_match( state, p1, p2 )
+    result['place'] = get_life_event_place_match( state, p1, p2 )
+    return result
+
+
+def get_finding_message( state, finding ):
+    # the words used in the text report
+    kind = finding.kind
+    relation = finding.relation
+    if relation == 'parent':
+       if kind == 'different':
+          return ['Parent(', finding.role, ') different from first to second']
+       return ['Parent(', finding.role, ') ' + kind + ' in second']
+    if relation == 'parents':
+       return ['Parent(s) ' + kind + ' in second']
+    if relation == 'child':
+       return ['with', get_partner_name(state,1,finding.partner), 'didnt match child', get_name(state,1,finding.other), 'first to second']
+    if relation == 'children':
+       if kind == 'unexplored':
+          return ['Children with', get_partner_name(state,1,finding.partner), 'not compared, the limit was reached']
+       return ['All children with', get_partner_name(state,1,finding.partner), kind + ' in second']
+    if relation == 'partner':
+       return ['Didnt match partner', get_partner_name(state,1,finding.other), 'first to second']
+    if relation == 'partners':
+       return ['Partner(s) ' + kind + ' in second']
+    if relation == 'name':
+       return ['Name different:', finding.scores['first'], 'to', finding.scores['second']]
+    if relation in ['date', 'place']:
+       values = [finding.scores[item] or 'none' for item in ['first', 'second']]
+       return [event_names[finding.role], relation, 'different:', values[0], 'to', values[1]]
+    if relation == 'event':
+       return [event_names[finding.role], kind, 'in second']
+    if relation == 'person':
+       if kind == 'unexplored':
+          return ['Not compared, the limit was reached']
+       return ['Not found in second']
+    if relation == 'people':
+       return ['The people not reached from here were not compared, the limit was reached']
+    assert False, 'Unknown finding ' + str(relation)
+
+
+class TextWriter:
+    # the original style of report
+
+    def __init__( self, state, outf ):
+        self.state = state
+        self.outf = outf
+
+    def start( self ):
+        print( 'Starting points', file=self.outf )
+        for i in [1,2]:
+            print( i, '=', show_indi( self.state, i, self.state.starts[i] ), file=self.outf )
+
+    def direction( self ):
+        print( '', file=self.outf )
+        print( 'Comparing', self.state.file_names[1], 'to', self.state.file_names[2], file=self.outf )
+
+    def write( self, finding ):
+        print( '', file=self.outf )
+        print( show_indi( self.state, 1, finding.xref1 ), file=self.outf )
+        print( *get_finding_message( self.state, finding ), file=self.outf )
+
+    def close( self ):
+        self.outf.flush()
+
+
+class JsonLinesWriter:
+    # one json object per line, for other programs
+
+    def __init__( self, state, outf ):
+        self.state = state
+        self.outf = outf
+
+    def output( self, data ):
+        self.outf.write( json.dumps( data ) + '\n' )
+
+    def start( self ):
+        for i in [1,2]:
+            self.output( {'kind':'start', 'tree':i, 'file':self.state.file_names[i], 'xref':self.state.starts[i]} )
+
+    def direction( self ):
+        self.output( {'kind':'direction', 'file1':self.state.file_names[1], 'file2':self.state.file_names[2]} )
+
+    def write( self, finding ):
+        data = finding._asdict()
+        data['direction'] = 'second-to-first' if self.state.trees_swapped else 'first-to-second'
+        self.output( data )
+
+    def close( self ):
+        self.outf.flush()
+
+
+def get_new_path( state, p, known ):
+    # the person and their relatives back towards a starting person,
+    # stopping at anyone already known
+    result = []
+    while p is not None and (state.trees_swapped, p) not in known:
+        result.append( p )
+        p = state.reached_from.get( p )
+    return result
+
+
+# text colours for the graph nodes
+finding_colors = {'added':'#2980b9', 'removed':'#c0392b', 'different':'#d35400',
+                  'unmatched':'#d35400', 'not-found':'#c0392b', 'unexplored':'#7f8c8d'}
+path_color = '#27ae60'
+
+
+class GraphmlWriter:
+    # only the people with differences, plus those linking them to the starting
+    # people, become nodes. Each difference is a node attached to its person.
+    # The attributes match the Cytoscape style in examples/graphml/styles.xml
+    # Written as the differences are found, only the node ids are kept.
+
+    def __init__( self, state, outf ):
+        self.state = state
+        self.outf = outf
+        self.node_ids = dict()
+        self.n_nodes = 0
+        self.n_edges = 0
+
+    def add_node( self, name, color ):
+        node_id = 'n' + str( self.n_nodes )
+        self.n_nodes += 1
+        self.outf.write( '    <node id="' + node_id + '">\n' )
+        self.outf.write( '      <data key="d0">' + xml.sax.saxutils.escape( name ) + '</data>\n' )
+        self.outf.write( '      <data key="d1">' + color + '</data>\n' )
+        self.outf.write( '    </node>\n' )
+        return node_id
+
+    def add_edge( self, source, target, color=None ):
+        edge = '    <edge id="e' + str( self.n_edges ) + '" source="' + source + '" target="' + target + '"'
+        self.n_edges += 1
+        if color:
+           edge += '>\n       <data key="d2">' + color + '</data>\n    </edge>\n'
+        else:
+           edge += '/>\n'
+        self.outf.write( edge )
+
+    def add_person( self, p ):
+        # return the node of the person, adding their path if needed
+        path = get_new_path( self.state, p, self.node_ids )
+        for person in reversed( path ):
+            node_id = self.add_node( show_indi( self.state, 1, person ), path_color )
+            self.node_ids[(self.state.trees_swapped, person)] = node_id
+            via = self.state.reached_from.get( person )
+            if via is not None:
+               self.add_edge( self.node_ids[(self.state.trees_swapped, via)], node_id )
+        return self.node_ids[(self.state.trees_swapped, p)]
+
+    def start( self ):
+        self.outf.write( '<?xml version="1.0" encoding="UTF-8"?>\n' )
+        self.outf.write( '<graphml xmlns="http://graphml.graphdrawing.org/xmlns"\n' )
+        self.outf.write( '      xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"\n' )
+        self.outf.write( '      xsi:schemaLocation="http://graphml.graphdrawing.org/xmlns\n' )
+        self.outf.write( '        http://graphml.graphdrawing.org/xmlns/1.0/graphml.xsd">\n' )
+        self.outf.write( '  <key id="d0" for="node" attr.name="name" attr.type="string"/>\n' )
+        self.outf.write( '  <key id="d1" for="node" attr.name="color" attr.type="string">\n' )
+        self.outf.write( '    <default>' + path_color + '</default>\n' )
+        self.outf.write( '  </key>\n' )
+        self.outf.write( '  <key id="d2" for="edge" attr.name="color" attr.type="string"/>\n' )
+        self.outf.write( '  <graph id="G" edgedefault="undirected">\n' )
+
+    def direction( self ):
+        # each direction has its own nodes, the keys include the direction
+        pass
+
+    def write( self, finding ):
+        person = self.add_person( finding.xref1 )
+        message = ' '.join( get_finding_message( self.state, finding ) )
+        node_id = self.add_node( message, finding_colors[finding.kind] )
+        self.add_edge( person, node_id, 'orange' )
+
+    def close( self ):
+        self.outf.write( '  </graph>\n' )
+        self.outf.write( '</graphml>\n' )
+        self.outf.flush()
+
+
+def write_nested_json( data, outf ):
+    # the same as json.dump, but with a stack rather than recursion
+    # so that a long line of relatives doesn't reach the python recursion limit.
+    # Each entry of the stack is the (key, value) items still to write, and the closing bracket
+    stack = [(iter( [(None, data)] ), '')]
+    first = True
+    while stack:
+        items, closing = stack[-1]
+        item = next( items, None )
+        if item is None:
+           outf.write( closing )
+           stack.pop()
+           first = False
+           continue
+
+        if not first:
+           outf.write( ', ' )
+        key, value = item
+        if key is not None:
+           outf.write( json.dumps( key ) + ': ' )
+
+        if isinstance( value, dict ):
+           outf.write( '{' )
+           stack.append( (iter( value.items() ), '}') )
+           first = True
+        elif isinstance( value, list ):
+           outf.write( '[' )
+           stack.append( (((None, x) for x in value), ']') )
+           first = True
+        else:
+           outf.write( json.dumps( value ) )
+           first = False
+
+
+class D3Writer:
+    # nested json of name and children, as used by d3.hierarchy and the
+    # collapsible tree examples. Pruned to the differences and the people
+    # linking them to the starting people. Since the nesting can't be written
+    # until the end only that pruned tree is held in memory.
+
+    def __init__( self, state, outf ):
+        self.state = state
+        self.outf = outf
+        self.nodes = dict()
+        self.root = {'name':'', 'children':[]}
+        self.top = self.root
+
+    def start( self ):
+        self.root['name'] = 'Differences of ' + self.state.file_names[1] + ' and ' + self.state.file_names[2]
+
+    def direction( self ):
+        self.top = {'name':'Comparing ' + self.state.file_names[1] + ' to ' + self.state.file_names[2], 'children':[]}
+        self.root['children'].append( self.top )
+
+    def add_person( self, p ):
+        path = get_new_path( self.state, p, self.nodes )
+        for person in reversed( path ):
+            node = {'name':show_indi( self.state, 1, person ), 'xref':person, 'children':[]}
+            self.nodes[(self.state.trees_swapped, person)] = node
+            via = self.state.reached_from.get( person )
+            if via is None:
+               self.top['children'].append( node )
+            else:
+               self.nodes[(self.state.trees_swapped, via)]['children'].append( node )
+        return self.nodes[(self.state.trees_swapped, p)]
+
+    def write( self, finding ):
+        person = self.add_person( finding.xref1 )
+        message = ' '.join( get_finding_message( self.state, finding ) )
+        person['children'].append( {'name':message, 'kind':finding.kind} )
+
+    def close( self ):
+        write_nested_json( self.root, self.outf )
+        self.outf.write( '\n' )
+        self.outf.flush()
+
+
+writers = {'text':TextWriter, 'jsonl':JsonLinesWriter, 'graphml':GraphmlWriter, 'd3':D3Writer}
+
+
+def open_output( state, file_name ):
+    # the report is written in large blocks rather than by line
+    size = 1024 * 1024
+    if file_name:
+       outf = open( file_name, 'w', encoding='utf-8', buffering=size )
+    else:
+       outf = open( sys.stdout.fileno(), 'w', encoding=sys.stdout.encoding, buffering=size, closefd=False )
+    return writers[state.options['format']]( state, outf )
+
+
+def get_name_match_value( state, n1, n2, limit=None ):
+    # the difflib.SequenceMatcher ratio
+    # though if a limit is given, and the ratio can't reach it, an upper bound
+    # which is also under the limit might be returned instead
+    key = (n1, n2)
+    result = state.name_match_results.get( key )
+    if result is not None:
+       if state.collect_stats:
+          state.counters['name-cache-hits'] += 1
+       # a comparison in another thread might have just dropped it
+       with contextlib.suppress( KeyError ):
+            state.name_match_results.move_to_end( key )
+       return result
+
+    if limit is not None:
+       # ratio is 2*matches/total_length, the matches can't be more than the shorter
+       total = len(n1) + len(n2)
+       if total:
+          bound = 2.0 * min( len(n1), len(n2) ) / total
+          if bound < limit:
+             if state.collect_stats:
+                state.counters['name-length-rejects'] += 1
+             return bound
+
+    if state.collect_stats:
+       state.counters['sequence-matchers'] += 1
+
+    matcher = difflib.SequenceMatcher( None, n1, n2 )
+    if limit is not None:
+       bound = matcher.quick_ratio()
+       if bound < limit:
+          if state.collect_stats:
+             state.counters['name-quick-rejects'] += 1
+          return bound
+
+    result = matcher.ratio()
+
+    state.name_match_results[key] = result
+    if len( state.name_match_results ) > name_cache_size:
+       with contextlib.suppress( KeyError ):
+            state.name_match_results.popitem( last=False )
+
     return result
 
 
-def show_person_header( t, p ):
-    print( '' )
-    print( show_indi( t, p ) )
+def normalize_place( place ):
+    # the same place is often written with different spacing around its parts
+    return ', '.join( [' '.join( part.split() ) for part in place.split( ',' )] )
+
+
+def get_place_id( state, place ):
+    # the number of the place in the table shared by both trees, None if no place
+    if not place:
+       return None
+    place = normalize_place( place )
+    if not place.strip( ', ' ):
+       return None
+    return state.places.get_id( place )
+
+
+def adopt_places( state, index, names ):
+    # the index was made with another place table, such as in the cache or another process,
+    # change it to the ids of this one
+    ids = [get_place_id( state, name ) for name in names]
+    for features in index.values():
+        features.places = tuple( [ids[x] if x is not None else x for x in features.places] )
+
+
+def get_place_match_value( state, id1, id2 ):
+    # the ratio of two places, computed once for each pair of places
+    if id1 == id2:
+       return 1.0
+    key = (id1, id2)
+    result = state.place_match_results.get( key )
+    if result is not None:
+       if state.collect_stats:
+          state.counters['place-cache-hits'] += 1
+       # a comparison in another thread might have just dropped it
+       with contextlib.suppress( KeyError ):
+            state.place_match_results.move_to_end( key )
+       return result
+
+    if state.collect_stats:
+       state.counters['place-matchers'] += 1
+
+    place1 = state.places.names[id1]
+    place2 = state.places.names[id2]
+    if state.options['place-parts']:
+       # the smallest ratio of the parts in both, the country, county, town, etc.
+       parts1 = place1.split( ', ' )
+       parts2 = place2.split( ', ' )
+       n = min( len(parts1), len(parts2) )
+       result = 1.0
+       for part1, part2 in zip( parts1[-n:], parts2[-n:] ):
+           result = min( result, difflib.SequenceMatcher( None, part1, part2 ).ratio() )
+    else:
+       result = difflib.SequenceMatcher( None, place1, place2 ).ratio()
 
+    state.place_match_results[key] = result
+    if len( state.place_match_results ) > place_cache_size:
+       with contextlib.suppress( KeyError ):
+            state.place_match_results.popitem( last=False )
 
-def get_name_match_value( n1, n2 ):
-    return difflib.SequenceMatcher(None, n1, n2).ratio()
+    return result
 
 
-def get_life_event_place_match( p1, p2 ):
+def get_life_event_place_match( state, p1, p2 ):
     # return the smallest match
     result = 1.0
-    for e in life_events:
-         v1 = get_event_place( 1, p1, e )
-         if v1:
-            v2 = get_event_place( 2, p2, e )
-            if v2:
-               result = min( result, get_name_match_value( v1, v2 ) )
+    places1 = state.indexes[1][p1].places
+    places2 = state.indexes[2][p2].places
+    for i in range( len(life_events) ):
+         v1 = places1[i]
+         if v1 is not None:
+            v2 = places2[i]
+            if v2 is not None:
+               result = min( result, get_place_match_value( state, v1, v2 ) )
     return result
 
 
-def get_life_event_date_match( p1, p2 ):
+def get_life_event_date_match( state, p1, p2 ):
      # return the largest difference
      result = 0
-     for e in life_events:
-         v1 = get_full_date( 1, p1, e )
-         if v1:
-            v2 = get_full_date( 2, p2, e )
-            if v2:
-               result = max( result, days_between( v1, v2 ) )
+     days1 = state.indexes[1][p1].days
+     days2 = state.indexes[2][p2].days
+     for i in range( len(life_events) ):
+         v1 = days1[i]
+         if v1 is not None:
+            v2 = days2[i]
+            if v2 is not None:
+               result = max( result, abs( v1 - v2 ) )
      return result
 
 
-def get_name_match( p1, p2 ):
-    v1 = get_name( 1, p1 )
-    v2 = get_name( 2, p2 )
-    return get_name_match_value( v1, v2 )
-
-
-def is_same_person( p1, p2 ):
-    if get_name_match( p1, p2 ) < options['person-name-diff']:
+def get_name_match( state, p1, p2 ):
+    # values under the same person limit don't need to be exact
+    return get_name_match_value( state, state.indexes[1][p1].name, state.indexes[2][p2].name, state.options['person-name-diff'] )
+
+
+def get_sweep_scores( state, p1, p2 ):
+    # the name, date and place values of the pair, computed once for all the sweep settings.
+    # Values under the smallest limit might not be exact, but are no match in every setting.
+    key = pair_key( state, p1, p2 )
+    if key not in state.sweep_scores:
+       if state.collect_stats:
+          state.counters['sweep-pairs-scored'] += 1
+       name_limit = min( state.options['sweep-name-diff'] or [state.options['person-name-diff']] )
+       name = get_name_match_value( state, state.indexes[1][p1].name, state.indexes[2][p2].name, name_limit )
+       place = get_life_event_place_match( state, p1, p2 )
+       state.sweep_scores[key] = (name, get_life_event_date_match( state, p1, p2 ), place)
+    return state.sweep_scores[key]
+
+
+def check_same_person( state, p1, p2 ):
+    if state.collect_stats:
+       state.counters['same-person-tests'] += 1
+    if state.sweep_scores is not None:
+       name, date, place = get_sweep_scores( state, p1, p2 )
+       return name >= state.options['person-name-diff'] and date <= state.options['person-date-diff'] and place >= state.options['person-place-diff']
+    if get_name_match( state, p1, p2 ) < state.options['person-name-diff']:
        return False
-    if get_life_event_date_match( p1, p2 ) > options['person-date-diff']:
+    if get_life_event_date_match( state, p1, p2 ) > state.options['person-date-diff']:
        return False
-    if get_life_event_place_match( p1, p2 ) < options['person-place-diff']:
+    if get_life_event_place_match( state, p1, p2 ) < state.options['person-place-diff']:
        return False
     return True
 
 
-def person_match_value( p1, p2 ):
+def pair_key( state, p1, p2 ):
+    # the person comparisons are symmetric, so key the saved results
+    # in the original tree order to let the reverse direction reuse them
+    if state.trees_swapped:
+       return (p2, p1)
+    return (p1, p2)
+
+
+def is_same_person( state, p1, p2 ):
+    key = pair_key( state, p1, p2 )
+    if key not in state.same_person_results:
+       state.same_person_results[key] = check_same_person( state, p1, p2 )
+    elif state.collect_stats:
+       state.counters['same-person-cache-hits'] += 1
+    return state.same_person_results[key]
+
+
+def person_match_value( state, p1, p2 ):
     # for now, only check the name
-    return get_name_match( p1, p2 )
+    key = pair_key( state, p1, p2 )
+    if key not in state.match_value_results:
+       if state.collect_stats:
+          state.counters['match-values'] += 1
+       if state.sweep_scores is not None:
+          state.match_value_results[key] = get_sweep_scores( state, p1, p2 )[0]
+       else:
+          state.match_value_results[key] = get_name_match( state, p1, p2 )
+    elif state.collect_stats:
+       state.counters['match-value-cache-hits'] += 1
+    return state.match_value_results[key]
 
 
-def follow_parents( p1, p2 ):
-    if show_debug:
-       print( 'debug:follow parents of', get_name(1,p1) )
+def swap_trees( state ):
+    # exchange the first and second trees, to compare in the other direction
+    for data in [state.trees, state.indexes, state.starts, state.file_names, state.dirty_people, state.dirty_families, state.subtree_hashes]:
+        data[1], data[2] = data[2], data[1]
+    state.trees_swapped = not state.trees_swapped
 
-    def get_famc( t, p ):
-        result = None
-        if 'famc' in trees[t][ikey][p]:
-           result = trees[t][ikey][p]['famc'][0]
-        return result
 
-    def get_partner( t, f, partner ):
-        result = None
-        if partner in trees[t][fkey][f]:
-           result = trees[t][fkey][f][partner][0]
-        return result
+def build_blocks( state, t ):
+    # group the people by surname sound and birth decade
+    # so that only people in nearby groups need to be compared
+    # return [surname-code][decade] = list of people, where decade might be None
+    birth = life_events.index( 'birt' )
+    result = dict()
+    for p in state.indexes[t]:
+        features = state.indexes[t][p]
+        decade = None
+        if features.days[birth] is not None:
+           decade = features.days[birth] // 3650
+        if features.surname_code not in result:
+           result[features.surname_code] = dict()
+        if decade not in result[features.surname_code]:
+           result[features.surname_code][decade] = []
+        result[features.surname_code][decade].append( p )
+    return result
 
-    fam1 = get_famc( 1, p1 )
-    fam2 = get_famc( 2, p2 )
+
+def get_block_candidates( state, blocks, p ):
+    # people in the second tree who might be the same as this tree1 person
+    result = []
+    features = state.indexes[1][p]
+    if features.surname_code in blocks:
+       decades = blocks[features.surname_code]
+       birth = features.days[life_events.index( 'birt' )]
+       if birth is None:
+          # could be anyone with a similar name
+          for decade in decades:
+              result.extend( decades[decade] )
+       else:
+          # people with no birth date aren't excluded by date
+          wanted = [None]
+          span = state.options['person-date-diff'] // 3650 + 1
+          for decade in range( birth // 3650 - span, birth // 3650 + span + 1 ):
+              wanted.append( decade )
+          for decade in wanted:
+              if decade in decades:
+                 result.extend( decades[decade] )
+    return result
+
+
+def match_all_people( state ):
+    # pair the people of tree1 not reached by the walk with tree2 regardless of relations,
+    # leaving out the tree2 people the walk has already matched
+    # return [tree1 person] = tree2 person, or None if the limits are reached first
+    blocks = build_blocks( state, 2 )
+
+    # in the style of the sorted matcher, but only for people in the same blocks
+    position2 = dict()
+    for i, p in enumerate( state.indexes[2] ):
+        position2[p] = i
+
+    matched2 = set( state.matched_pairs.values() )
+
+    pairs = []
+    for i, p1 in enumerate( state.indexes[1] ):
+        if is_over_budget( state ):
+           return None
+        if p1 in state.visited:
+           continue
+        for p2 in get_block_candidates( state, blocks, p1 ):
+            if p2 in matched2:
+               continue
+            if is_same_person( state, p1, p2 ):
+               pairs.append( (-person_match_value( state, p1, p2 ), i, position2[p2], p1, p2) )
+    pairs.sort()
+
+    result = dict()
+    for pair in pairs:
+        p1 = pair[3]
+        p2 = pair[4]
+        if p1 not in result and p2 not in matched2:
+           result[p1] = p2
+           matched2.add( p2 )
+    return result
+
+
+def follow_all_people( state, position=0, work=None ):
+    # everyone not reached from the starting points
+    # gets compared with their best match, if any
+    # from a checkpoint, continue with the work of the person at the position
+    # generates the findings
+    # once the limits are reached, one finding marks the people not compared
+    unexplored = Finding( 'unexplored', 'people', state.starts[1], state.starts[2], None, None, None, None )
+    matched = None
+    if not is_over_budget( state ):
+       matched = match_all_people( state )
+    if matched is None:
+       if work is not None:
+          yield from run_work( state, work )
+       yield unexplored
+       return
+
+    people = list( state.indexes[1] )
+    for i in range( position, len( people ) ):
+        p1 = people[i]
+        state.walk_state['position'] = i
+        if work is not None:
+           yield from run_work( state, work )
+           work = None
+        elif p1 not in state.visited:
+           if is_over_budget( state ):
+              yield unexplored
+              return
+           if p1 in matched:
+              yield from follow_trees( state, p1, matched[p1] )
+           else:
+              yield Finding( 'not-found', 'person', p1, None, None, None, None, None )
+
+
+def follow_parents( state, p1, p2 ):
+    # return the work needed to compare the parents of the matched pair
+    if show_debug:
+       print( 'debug:follow parents of', get_name(state,1,p1) )
+
+    work = []
+
+    fam1 = get_parent_family( state, 1, p1 )
+    fam2 = get_parent_family( state, 2, p2 )
 
     if fam1:
        if fam2:
           # this is going the be trouble for same sex couples
           for partner in ['wife','husb']:
-              partner1 = get_partner( 1, fam1, partner )
-              partner2 = get_partner( 2, fam2, partner )
+              partner1 = get_family_partner( state, 1, fam1, partner )
+              partner2 = get_family_partner( state, 2, fam2, partner )
 
               if partner1:
                  if partner2:
-                    if is_same_person( partner1, partner2 ):
+                    if is_same_person( state, partner1, partner2 ):
                        # now what, check details
                        if show_debug:
-                          print( 'debug:matched parent', partner, get_name(1,partner1) )
-                       follow_person( partner1, partner2 )
+                          print( 'debug:matched parent', partner, get_name(state,1,partner1) )
+                       work.append( ('person', partner1, partner2, p1, 'parent') )
                     else:
-                       show_person_header( 1, p1 )
-                       print( 'Parent(', partner, ') different from first to second' )
+                       scores = get_person_scores( state, partner1, partner2 )
+                       work.append( report( 'different', 'parent', p1, p2, role=partner, other=partner1, scores=scores ) )
                  else:
-                    show_person_header( 1, p1 )
-                    print( 'Parent(', partner, ') removed in second' )
+                    work.append( report( 'removed', 'parent', p1, p2, role=partner, other=partner1 ) )
               else:
                  if partner2:
-                    show_person_header( 1, p1 )
-                    print( 'Parent(', partner, ') added in second' )
+                    work.append( report( 'added', 'parent', p1, p2, role=partner ) )
        else:
-          show_person_header( 1, p1 )
-          print( 'Parent(s) removed in second' )
+          work.append( report( 'removed', 'parents', p1, p2 ) )
 
     else:
       if fam2:
-         show_person_header( 1, p1 )
-         print( 'Parent(s) added in second' )
+         work.append( report( 'added', 'parents', p1, p2 ) )
 
+    return work
 
-def max_in_matrix( m ):
-    # should be a pythonic way to do this
+
+def max_in_matrix( m, matched1, matched2 ):
+    # largest value among the rows and columns not yet matched
     x = -1
-    for i in m:
-        for j in m[i]:
-            x = max( x, m[i][j] )
+    for i, row in enumerate( m ):
+        if i not in matched1:
+           for j, value in enumerate( row ):
+               if j not in matched2:
+                  x = max( x, value )
     return x
 
 
-def follow_children( p1, partner1, f1, f2 ):
-    global visited_fam
-    if f1 in visited_fam:
-       return
-    visited_fam.append(f1)
+def greedy_match( scores, limit ):
+    # repeatedly pair off the largest remaining value
+    matched1 = dict()
+    matched2 = dict()
+
+    best = max_in_matrix( scores, matched1, matched2 )
+
+    while best >= limit:
+        # where did it occur
+        for i, row in enumerate( scores ):
+            if i not in matched1:
+               for j, value in enumerate( row ):
+                   if j not in matched2:
+                      if value >= best:
+                         row[j] = -1
+                         matched1[i] = j
+                         matched2[j] = i
+        best = max_in_matrix( scores, matched1, matched2 )
+
+    return matched1
+
+
+def sorted_match( scores, limit ):
+    # sort all the pairings once, then take them from the best down
+    # ties are taken in tree order
+    pairs = []
+    for i, row in enumerate( scores ):
+        for j, value in enumerate( row ):
+            if value >= limit:
+               pairs.append( (-value, i, j) )
+    pairs.sort()
+
+    matched1 = dict()
+    matched2 = dict()
+    for pair in pairs:
+        i = pair[1]
+        j = pair[2]
+        if i not in matched1 and j not in matched2:
+           matched1[i] = j
+           matched2[j] = i
+
+    return matched1
+
+
+def optimal_match( scores, limit ):
+    # the pairing with the largest total value, via the Hungarian method
+    # in its shortest augmenting path form, with values under the limit
+    # counting as no match
+    weights = numpy.array( scores, dtype=float )
+    weights[weights < limit] = 0.0
+
+    # the method needs no more rows than columns
+    transposed = weights.shape[0] > weights.shape[1]
+    if transposed:
+       weights = weights.T
+
+    n_rows, n_cols = weights.shape
+    cost = -weights
+
+    # potentials and assignments, 1-based with 0 as a dummy
+    u = numpy.zeros( n_rows + 1 )
+    v = numpy.zeros( n_cols + 1 )
+    row_of_col = numpy.zeros( n_cols + 1, dtype=int )
+    way = numpy.zeros( n_cols + 1, dtype=int )
+
+    for i in range( 1, n_rows + 1 ):
+        row_of_col[0] = i
+        col = 0
+        min_value = numpy.full( n_cols + 1, numpy.inf )
+        used = numpy.zeros( n_cols + 1, dtype=bool )
+
+        while True:
+            used[col] = True
+            row = row_of_col[col]
+
+            free = ~used[1:]
+            reduced = cost[row-1] - u[row] - v[1:]
+            better = free & ( reduced < min_value[1:] )
+            min_value[1:][better] = reduced[better]
+            way[1:][better] = col
+
+            candidates = numpy.where( free, min_value[1:], numpy.inf )
+            next_col = int( numpy.argmin( candidates ) ) + 1
+            delta = candidates[next_col-1]
+
+            used_cols = numpy.nonzero( used )[0]
+            u[row_of_col[used_cols]] += delta
+            v[used_cols] -= delta
+            min_value[1:][free] -= delta
+
+            col = next_col
+            if row_of_col[col] == 0:
+               break
+
+        # flip the assignments along the path
+        while col:
+            prev_col = way[col]
+            row_of_col[col] = row_of_col[prev_col]
+            col = prev_col
+
+    matched1 = dict()
+    for j in range( 1, n_cols + 1 ):
+        if row_of_col[j]:
+           i = row_of_col[j] - 1
+           if transposed:
+              i, j_index = j - 1, i
+           else:
+              j_index = j - 1
+           if scores[i][j_index] >= limit:
+              matched1[i] = j_index
+
+    return matched1
+
+
+matchers = {'greedy':greedy_match, 'sorted':sorted_match, 'optimal':optimal_match}
+
+
+def match_best( state, keys1, keys2, get_value ):
+    # find the best pairing of the tree1 keys to the tree2 keys
+    # return [key1] = key2, for those which match well enough
+    if state.collect_stats:
+       wall = time.perf_counter()
+       cpu = time.process_time()
+       size = len( keys1 ) * len( keys2 )
+       state.counters['largest-match-matrix'] = max( size, state.counters['largest-match-matrix'] )
+
+    scores = []
+    for k1 in keys1:
+        row = []
+        for k2 in keys2:
+            row.append( get_value( k1, k2 ) )
+        scores.append( row )
+
+    keys1 = list( keys1 )
+    keys2 = list( keys2 )
+
+    result = dict()
+    matched = matchers[state.options['matcher']]( scores, state.options['person-name-diff'] )
+    for i in matched:
+        result[keys1[i]] = keys2[matched[i]]
+
+    if state.collect_stats:
+       # part of the compare phase
+       add_phase_time( state, 'matching', wall, cpu )
+
+    return result
+
+
+def get_step( state, key, unchanged, compare ):
+    # the work from comparing a pair, taken from the baseline if their records are unchanged
+    if unchanged and key in state.baseline_steps:
+       if state.collect_stats:
+          state.counters['baseline-steps-reused'] += 1
+       result = state.baseline_steps[key]
+    else:
+       result = compare()
+    if state.saved_steps is not None:
+       state.saved_steps[key] = result
+    return result
 
-    def match_children( p1, partner_name, children1, children2 ):
-        # make a matrix of matches to try gettimg the closest pairings
-        match_values = dict()
-        for c1 in children1:
-            match_values[c1] = dict()
-            for c2 in children2:
-                match_values[c1][c2] = person_match_value( c1, c2 )
-
-        matched1 = dict()
-        matched2 = dict()
-
-        best = max_in_matrix( match_values )
-
-        while best >= options['person-name-diff']:
-            # where did it occur
-            # there might be a pythonic way to do this
-            for c1 in children1:
-                if c1 not in matched1:
-                   for c2 in children2:
-                       if c2 not in matched2:
-                          if match_values[c1][c2] >= best:
-                             match_values[c1][c2] = -1
-                             matched1[c1] = c2
-                             matched2[c2] = c1
-            best = max_in_matrix( match_values )
 
+def follow_children( state, p1, p2, partner1, f1, f2 ):
+    # return the work needed to compare the children of the matched families
+    if not follows_children( state, p1 ):
+       return []
+    if f1 in state.visited_fam:
+       return []
+    state.visited_fam.add( f1 )
+    if state.collect_stats:
+       state.counters['families-visited'] += 1
+
+    key = ('children', p1, p2, partner1, f1, f2)
+    unchanged = f1 not in state.dirty_families[1] and f2 not in state.dirty_families[2]
+    return get_step( state, key, unchanged, lambda: compare_children( state, p1, p2, partner1, f1, f2 ) )
+
+
+def compare_children( state, p1, p2, partner1, f1, f2 ):
+    # return the work needed to compare the children of the matched families
+    def match_children( children1, children2 ):
+        # try gettimg the closest pairings
+        matched1 = match_best( state, children1, children2, lambda c1, c2: person_match_value( state, c1, c2 ) )
+
+        work = []
         for c1 in children1:
             if c1 in matched1:
-               follow_person( c1, matched1[c1] )
+               work.append( ('person', c1, matched1[c1], p1, 'child') )
 
             else:
-               show_person_header( 1, p1 )
-               print( 'with', partner_name, 'didnt match child', get_name(1,c1), 'first to second' )
+               work.append( report( 'unmatched', 'child', p1, p2, partner=partner1, other=c1 ) )
+        return work
 
-    partner_name = get_name(1,partner1)
+    work = []
 
     if show_debug:
-       print( 'debug:follow children', get_name(1,p1),' and ', partner_name )
+       print( 'debug:follow children', get_name(state,1,p1),' and ', get_partner_name(state,1,partner1) )
 
-    children1 = trees[1][fkey][f1]['chil']
-    children2 = trees[2][fkey][f2]['chil']
+    children1 = get_children( state, 1, f1 )
+    children2 = get_children( state, 2, f2 )
     if children1:
        if children2:
-          match_children( p1, partner_name, children1, children2 )
+          work = match_children( children1, children2 )
 
        else:
-         show_person_header( 1, p1 )
-         print( 'All children with',partner_name,'removed in second' )
+         work.append( report( 'removed', 'children', p1, p2, partner=partner1 ) )
     else:
        if children2:
-          show_person_header( 1, p1 )
-          print( 'All children with',partner_name,'added in second' )
-
-
-def follow_partners( p1, p2 ):
-    if show_debug:
-       print( 'debug:in follow partners', get_name(1,p1) )
+          work.append( report( 'added', 'children', p1, p2, partner=partner1 ) )
 
-    def match_partners( p1, partners1, partners2 ):
-        # make a matrix of tree1 people to tree2 people
-        # in order to find the best matches
+    return work
 
-        match_values = dict()
 
-        for fam1 in partners1:
-            partner1 = partners1[fam1]
-            match_values[fam1] = dict()
-            for fam2 in partners2:
-                partner2 = partners2[fam2]
-                match_values[fam1][fam2] = person_match_value( partner1, partner2 )
+def follow_partners( state, p1, p2 ):
+    # return the work needed to compare the partners of the matched pair
+    if show_debug:
+       print( 'debug:in follow partners', get_name(state,1,p1) )
 
+    def match_partners( partners1, partners2 ):
         # find the best match for each,
         # so long as it isn't a better match for someone else
 
-        matched1 = dict()
-        matched2 = dict()
-
-        best = max_in_matrix( match_values )
+        def partner_match_value( fam1, fam2 ):
+            partner1 = partners1[fam1]
+            partner2 = partners2[fam2]
+            # unknown partners only go with unknown partners
+            if partner1 is None or partner2 is None:
+               if partner1 is None and partner2 is None:
+                  return 1.0
+               return -1
+            return person_match_value( state, partner1, partner2 )
 
-        while best >= options['person-name-diff']:
-            # where did it occur
-            # there might be a pythonic way to do this
-            for fam1 in partners1:
-                if fam1 not in matched1:
-                   for fam2 in partners2:
-                       if fam2 not in matched2:
-                          if match_values[fam1][fam2] >= best:
-                             match_values[fam1][fam2] = -1
-                             matched1[fam1] = fam2
-                             matched2[fam2] = fam1
-            best = max_in_matrix( match_values )
+        matched1 = match_best( state, partners1, partners2, partner_match_value )
 
+        work = []
         for fam1 in partners1:
             partner1 = partners1[fam1]
             if fam1 in matched1:
                fam2 = matched1[fam1]
-               follow_person( partner1, partners2[fam2] )
+               if partner1 is not None:
+                  work.append( ('person', partner1, partners2[fam2], p1, 'partner') )
 
                # now that families are known, do children within the family
-               follow_children( p1, partner1, fam1, fam2 )
+               work.append( ('children', p1, p2, partner1, fam1, fam2) )
 
             else:
-               show_person_header( 1, p1 )
-               print( 'Didnt match partner', get_name(1,partner1), 'first to second' )
+               work.append( report( 'unmatched', 'partner', p1, p2, other=partner1 ) )
+        return work
 
+    work = []
 
     # check all the partners that person 1 might share with person 2
-    partners1 = list_all_partners( 1, p1 )
-    partners2 = list_all_partners( 2, p2 )
+    partners1 = list_all_partners( state, 1, p1 )
+    partners2 = list_all_partners( state, 2, p2 )
 
     if partners1:
        if partners2:
-          match_partners( p1, partners1, partners2 )
+          work = match_partners( partners1, partners2 )
 
        else:
-          show_person_header( 1, p1 )
-          print( 'Partner(s) removed in second' )
+          work.append( report( 'removed', 'partners', p1, p2 ) )
     else:
        if partners2:
-          show_person_header( 1, p1 )
-          print( 'Partner(s) added in second' )
+          work.append( report( 'added', 'partners', p1, p2 ) )
 
+    return work
 
 
-def follow_person( p1, p2 ):
-    global visited
-    if p1 in visited:
-       return
-    visited.append( p1 )
+def follows_parents( state, generation ):
+    if state.options['scope'] == 'descendants':
+       return False
+    return state.options['generations-up'] is None or generation < state.options['generations-up']
+
+
+def follows_partners( state, relation ):
+    # the partners lead to the children
+    if state.options['scope'] == 'ancestors':
+       return False
+    # the partners of descendants are compared, but not their other families
+    return not (state.options['scope'] == 'descendants' and relation == 'partner')
+
+
+def follows_children( state, p ):
+    if state.options['generations-down'] is None:
+       return True
+    return state.generations[p] > -state.options['generations-down']
+
+
+def visit_person( state, p1, p2, via, relation ):
+    # mark the person as compared
+    # return their generation, above the start is positive
+    state.visited.add( p1 )
+    state.reached_from[p1] = via
+    state.matched_pairs[p1] = p2
+
+    generation = 0
+    if via is not None:
+       generation = state.generations[via] + generation_steps[relation]
+    state.generations[p1] = generation
+    return generation
+
+
+def get_person_content( state, t, p ):
+    # the values compared for a person, for the subtree hashes
+    features = state.indexes[t][p]
+    result = [features.name, features.days, features.places]
+    if state.options['details']:
+       result.append( sorted( get_event_details( state, t, p ).items() ) )
+    return result
+
+
+def get_subtree_parts( state, t, p ):
+    # the relatives whose subtree hashes are part of the person's
+    result = []
+    if state.options['scope'] == 'ancestors':
+       f = get_parent_family( state, t, p )
+       if f:
+          for partner in ['wife','husb']:
+              other = get_family_partner( state, t, f, partner )
+              if other:
+                 result.append( other )
+    else:
+       for f in get_partner_families( state, t, p ):
+           result.extend( get_children( state, t, f ) )
+    return result
+
+
+def make_subtree_hash( state, t, p ):
+    # from the hashes of the parts, which are known
+    # None if the walk might pair the relatives other than in their order,
+    # which is when names are repeated
+    hashes = state.subtree_hashes[t]
+    content = [get_person_content( state, t, p )]
+
+    if state.options['scope'] == 'ancestors':
+       f = get_parent_family( state, t, p )
+       if f:
+          content.append( 'parents' )
+          for partner in ['wife','husb']:
+              other = get_family_partner( state, t, f, partner )
+              if other:
+                 if hashes[other] is None:
+                    return None
+                 content.append( hashes[other] )
+              else:
+                 content.append( None )
+
+    else:
+       partner_names = set()
+       for f, partner in list_all_partners( state, t, p ).items():
+           partner_content = None
+           name = None
+           if partner is not None:
+              partner_content = get_person_content( state, t, partner )
+              name = state.indexes[t][partner].name
+           if name in partner_names:
+              return None
+           partner_names.add( name )
+
+           children = []
+           child_names = set()
+           for c in get_children( state, t, f ):
+               if hashes[c] is None or state.indexes[t][c].name in child_names:
+                  return None
+               child_names.add( state.indexes[t][c].name )
+               children.append( hashes[c] )
+           content.append( (partner_content, children) )
+
+    return hashlib.blake2b( repr( content ).encode(), digest_size=16 ).digest()
+
+
+def get_subtree_hash( state, t, p ):
+    # the hash of the person and all their ancestors, or descendants, as the scope
+    # computed without recursion, for deep trees
+    hashes = state.subtree_hashes[t]
+    started = set()
+    stack = [p]
+    while stack:
+        q = stack[-1]
+        if q in hashes:
+           stack.pop()
+        elif q not in started:
+           started.add( q )
+           for other in get_subtree_parts( state, t, q ):
+               if other not in hashes:
+                  if other in started:
+                     # a loop, someone recorded as their own ancestor
+                     hashes[other] = None
+                  else:
+                     stack.append( other )
+        else:
+           stack.pop()
+           hashes[q] = make_subtree_hash( state, t, q )
+    return hashes[p]
+
+
+def is_same_subtree( state, p1, p2 ):
+    # true if the pair has the same ancestors, or descendants, in both trees
+    # so walking the scope from them would find no differences.
+    # Not for the whole trees since any person can lead to all the others.
+    if state.options['scope'] == 'all':
+       return False
+    result = get_subtree_hash( state, 1, p1 )
+    return result is not None and result == get_subtree_hash( state, 2, p2 )
+
+
+def get_same_work( state, p1, p2, generation, relation ):
+    # the relatives of a pair with the same subtrees, to be marked as compared
+    # in the order which the walk would reach them, but without comparing
+    work = []
+    if follows_parents( state, generation ):
+       fam1 = get_parent_family( state, 1, p1 )
+       fam2 = get_parent_family( state, 2, p2 )
+       if fam1:
+          for partner in ['wife','husb']:
+              partner1 = get_family_partner( state, 1, fam1, partner )
+              if partner1:
+                 work.append( ('same', partner1, get_family_partner( state, 2, fam2, partner ), p1, 'parent') )
+    if follows_partners( state, relation ):
+       partners1 = list_all_partners( state, 1, p1 )
+       partners2 = list_all_partners( state, 2, p2 )
+       for fam1, fam2 in zip( partners1, partners2 ):
+           partner1 = partners1[fam1]
+           if partner1 is not None:
+              work.append( ('same', partner1, partners2[fam2], p1, 'partner') )
+           work.append( ('same-children', p1, p2, partner1, fam1, fam2) )
+    return work
+
+
+def follow_same( state, p1, p2, via, relation ):
+    # return the work of marking the relatives of a pair with the same subtrees
+    if p1 in state.visited:
+       return []
+    generation = visit_person( state, p1, p2, via, relation )
+    if state.collect_stats:
+       state.counters['people-skipped'] += 1
+    return get_same_work( state, p1, p2, generation, relation )
+
+
+def follow_same_children( state, p1, p2, partner1, f1, f2 ):
+    # return the work of marking the children of families with the same subtrees
+    if not follows_children( state, p1 ):
+       return []
+    if f1 in state.visited_fam:
+       return []
+    state.visited_fam.add( f1 )
+    work = []
+    for c1, c2 in zip( get_children( state, 1, f1 ), get_children( state, 2, f2 ) ):
+        work.append( ('same', c1, c2, p1, 'child') )
+    return work
+
+
+def follow_person( state, p1, p2, via, relation ):
+    # return the work needed to compare the relatives of the matched pair
+    # via is the tree1 relative through whom this person was reached,
+    # relation is what this person is to them
+    if p1 in state.visited:
+       return []
+    generation = visit_person( state, p1, p2, via, relation )
+    if state.collect_stats:
+       state.counters['people-visited'] += 1
 
     if show_debug:
-       print( 'debug:following person', show_indi( 1, p1 ) )
+       print( 'debug:following person', show_indi( state, 1, p1 ) )
+
+    if follows_parents( state, generation ) or follows_partners( state, relation ):
+       if is_same_subtree( state, p1, p2 ):
+          if state.collect_stats:
+             state.counters['same-subtrees'] += 1
+          return get_same_work( state, p1, p2, generation, relation )
+
+    unchanged = p1 not in state.dirty_people[1] and p2 not in state.dirty_people[2]
+
+    work = []
+    if follows_parents( state, generation ):
+       work.extend( get_step( state, ('parents', p1, p2), unchanged, lambda: follow_parents( state, p1, p2 ) ) )
+    if follows_partners( state, relation ):
+       work.extend( get_step( state, ('partners', p1, p2), unchanged, lambda: follow_partners( state, p1, p2 ) ) )
+    return work
+
+
+generation_steps = {'parent':1, 'partner':0, 'child':-1}
+
+
+def is_over_budget( state ):
+    if state.options['max-compared'] is not None and len( state.visited ) >= state.options['max-compared']:
+       return True
+    if state.options['time-limit'] is not None and time.perf_counter() - state.budget_start > state.options['time-limit']:
+       return True
+    return False
+
+
+def get_unexplored( state, item ):
+    # the finding for work not done because of the limits, or None
+    if item[0] in ['person', 'same']:
+       p1, p2, via = item[1:4]
+       # the same person might be reached more than once
+       if p1 in state.reached_from:
+          return None
+       # for the graphs
+       state.reached_from[p1] = via
+       return Finding( 'unexplored', 'person', p1, p2, None, None, None, None )
+
+    p1, p2, partner1, f1 = item[1:5]
+    if f1 in state.visited_fam or not follows_children( state, p1 ):
+       return None
+    state.visited_fam.add( f1 )
+    return Finding( 'unexplored', 'children', p1, p2, None, partner1, None, None )
+
+
+def do_work_item( state, item ):
+    # each item is a tuple of (kind, arguments...)
+    # returns any further work caused by the item, in report order
+    kind = item[0]
+    if kind == 'person':
+       return follow_person( state, *item[1:] )
+    if kind == 'children':
+       return follow_children( state, *item[1:] )
+    if kind == 'same':
+       return follow_same( state, *item[1:] )
+    if kind == 'same-children':
+       return follow_same_children( state, *item[1:] )
+    assert False, 'Unknown work item ' + str(kind)
+
+
+def get_checkpoint_settings( state ):
+    # a checkpoint is only continued by the same comparison of the same files
+    result = dict()
+    result['version'] = get_version()
+    for item in state.options:
+        if item not in ['output', 'stats', 'profile', 'checkpoint', 'checkpoint-interval', 'resume']:
+           result[item] = state.options[item]
+    for i in [1,2]:
+        info = os.stat( state.file_names[i] )
+        result['file' + str(i) + '-stat'] = (info.st_size, info.st_mtime_ns)
+    return result
 
-    # might pass same person test, but could have not-significant differences
-    #report_non_exact_items( p1, p2 )
 
-    follow_parents( p1, p2 )
-    follow_partners( p1, p2 )
+def read_checkpoint( state, file_name ):
+    result = None
+    if os.path.isfile( file_name ):
+       try:
+          with open( file_name, 'rb' ) as inf:
+               result = pickle.load( inf )
+       except (OSError, EOFError, pickle.UnpicklingError, AttributeError):
+          show_message( state, 'Ignoring unreadable checkpoint file', file_name )
+          result = None
+       if result and result['settings'] != state.checkpoint_settings:
+          show_message( state, 'Ignoring checkpoint of another comparison', file_name )
+          result = None
+    else:
+       show_message( state, 'No checkpoint, starting from the beginning', file_name )
+    return result
 
 
-# the tree data will be globals
-trees = []
-starts = []
-file_names = []
+def save_checkpoint( state ):
+    # called between work items, when the findings of the items done have been written
+    data = dict()
+    data['settings'] = state.checkpoint_settings
+    for item in ['direction', 'stage', 'position']:
+        data[item] = state.walk_state[item]
+    data['work'] = list( state.walk_state['work'] )
+    data['visited'] = state.visited
+    data['visited_fam'] = state.visited_fam
+    data['generations'] = state.generations
+    data['links'] = state.direction_links
+    data['pairs'] = state.direction_pairs
+    data['findings'] = state.written_findings
+    with timed_phase( state, 'checkpoint' ):
+         write_pickle( state.options['checkpoint'], data )
+    if state.collect_stats:
+       state.counters['checkpoints'] += 1
+
+
+def is_checkpoint_due( state ):
+    now = time.perf_counter()
+    if state.stop_requested or now >= state.next_checkpoint:
+       state.next_checkpoint = now + state.options['checkpoint-interval']
+       return True
+    return False
+
+
+def request_stop( state ):
+    # stop at the next checkpoint, a second signal stops at once
+    if state.stop_requested:
+       raise KeyboardInterrupt
+    state.stop_requested = True
+
+
+def run_work( state, work ):
+    # walk both trees using a work list rather than recursion,
+    # so that deep trees don't reach the python recursion limit.
+    # Depth first gives the same report order as the recursive walk did.
+    # generates the findings
+    depth_first = state.options['traversal'] == 'depth'
+
+    state.walk_state['work'] = work
+
+    while work:
+        if state.options['checkpoint'] and is_checkpoint_due( state ):
+           save_checkpoint( state )
+           if state.stop_requested:
+              show_message( state, 'Stopped, continue with --resume' )
+              sys.exit(1)
+
+        if depth_first:
+           item = work.pop()
+        else:
+           item = work.popleft()
 
-# add an initial zero'th element so that the rest of the program uses 1 and 2
-trees.append(0)
-starts.append(0)
-file_names.append(0)
+        if item[0] == 'report':
+           yield item[1]
 
-options = get_program_options()
+        elif is_over_budget( state ):
+           # the rest of the work marks where the walk stopped
+           finding = get_unexplored( state, item )
+           if finding:
+              yield finding
 
-readgedcom = load_my_module( 'readgedcom', options['libpath'] )
+        else:
+           more_work = do_work_item( state, item )
+           if depth_first:
+              # reversed so that the first new item is the next one handled
+              work.extend( reversed( more_work ) )
+           else:
+              work.extend( more_work )
+
+
+def get_branch_people( state, item ):
+    # the people not yet visited whom the work item reaches first
+    result = set()
+    if item[0] in ['person', 'same']:
+       p = item[1]
+       result.add( p )
+       f = get_parent_family( state, 1, p )
+       if f:
+          for partner in ['wife','husb']:
+              result.add( get_family_partner( state, 1, f, partner ) )
+       result.update( list_all_partners( state, 1, p ).values() )
+    elif item[0] in ['children', 'same-children']:
+       result.add( item[3] )
+       result.update( get_children( state, 1, item[4] ) )
+    result.discard( None )
+    return result - state.visited
+
+
+def get_branches( state, work ):
+    # the work list in walk order, as branches which can't reach the same people.
+    # Items reaching any of the same people first, such as a partner and the children
+    # of the couple, go together along with the items between them to keep the walk order
+    items = list( reversed( work ) )
+    first = dict()
+    ends = list( range( len( items ) ) )
+    for i, item in enumerate( items ):
+        for p in get_branch_people( state, item ):
+            if p in first:
+               ends[first[p]] = i
+            else:
+               first[p] = i
+
+    result = []
+    start = 0
+    end = 0
+    for i in range( len( items ) ):
+        end = max( end, ends[i] )
+        if i == end:
+           result.append( items[start:i+1] )
+           start = i + 1
+    return result
 
-ikey = readgedcom.PARSED_INDI
-fkey = readgedcom.PARSED_FAM
 
-file_names.append( options['file1'] )
-starts.append( options['id1'] )
-file_names.append( options['file2'] )
-starts.append( options['id2'] )
+def get_branch_work( state, items ):
+    # the work list which handles the items in the given order
+    if state.options['traversal'] == 'depth':
+       return collections.deque( reversed( items ) )
+    return collections.deque( items )
 
-ok = True
 
-# not good for o/s with significant case files
-if file_names[1].lower() == file_names[2].lower():
-   print( 'Identical files', file=sys.stderr )
-   sys.exit(1)
+def set_worker_state( state ):
+    # start a worker process of the pool,
+    # which has the comparison from the fork rather than a pickled copy
+    global worker_state
+    worker_state = state
 
-# this will cause exit if the input data is very bad
-for i in [1,2]:
-    trees.append( readgedcom.read_file( file_names[i] ) )
 
-print( 'Starting points' )
-for i in [1,2]:
-    if isinstance( trees[i], dict ) and ikey in trees[i]:
-       selected = readgedcom.find_individuals( trees[i], options['iditem'], starts[i] )
-       n = len(selected)
-       if n == 1:
-          starts[i] = selected[0]
-          print( i, '=', show_indi( i, starts[i] ) )
-       else:
-          ok = False
-          mess = 'Given person id ' + str(starts[i]) + ' '
-          if n < 1:
-             mess += 'not in tree:'
-          else:
-             mess += 'matched more than 1 person:'
-          print( mess, file_names[i], file=sys.stderr )
+def get_process_pool( state, jobs ):
+    # the worker processes for this comparison
+    context = multiprocessing.get_context( 'fork' )
+    return concurrent.futures.ProcessPoolExecutor( jobs, mp_context=context,
+                                                   initializer=set_worker_state, initargs=(state,) )
+
+
+def in_worker( function, *args ):
+    # run a function of the comparison in a worker process
+    return function( worker_state, *args )
+
+
+def follow_branch( state, items ):
+    # run in a worker process, from the visits made before the pool started
+    # return the findings and the new visits
+    state.visited = set( state.branch_visited )
+    state.visited_fam = set( state.branch_visited_fam )
+    state.counters.clear()
+    state.phase_times.clear()
+    if state.saved_steps is not None:
+       state.saved_steps.clear()
+
+    findings = list( run_work( state, get_branch_work( state, items ) ) )
+
+    people = state.visited - state.branch_visited
+    # in the order visited, for the details
+    links = dict()
+    for p in state.matched_pairs:
+        if p in people:
+           links[p] = (state.reached_from[p], state.generations[p], state.matched_pairs[p])
+
+    return findings, people, state.visited_fam - state.branch_visited_fam, links, state.counters, state.phase_times, state.saved_steps
+
+
+def follow_in_parallel( state, work ):
+    # walk here until there are enough separate branches to share out
+    # generates the findings
+    # but not so far that most of the walk is done here
+    wanted = state.options['jobs'] * 4
+    while work and len( work ) < wanted * 4:
+        if len( work ) >= wanted and len( get_branches( state, work ) ) >= wanted:
+           break
+        item = work.pop()
+        if item[0] == 'report':
+           yield item[1]
+        else:
+           work.extend( reversed( do_work_item( state, item ) ) )
+
+    # in the order the walk would have done them
+    branches = get_branches( state, work )
+    if len( branches ) < 2:
+       yield from run_work( state, work )
+       return
+
+    # the workers get a copy of these as the pool starts
+    state.branch_visited = frozenset( state.visited )
+    state.branch_visited_fam = frozenset( state.visited_fam )
+
+    sys.stdout.flush()
+
+    with get_process_pool( state, state.options['jobs'] ) as pool:
+         results = [pool.submit( in_worker, follow_branch, items ) for items in branches]
+
+         # take the results in the walk order so the report is always the same
+         for items, result in zip( branches, results ):
+             findings, people, families, links, branch_counters, branch_times, branch_steps = result.result()
+             # the comparisons are the same whichever branch made them
+             if state.saved_steps is not None:
+                state.saved_steps.update( branch_steps )
+             # the work was done even if the results are not used
+             if state.collect_stats:
+                add_counters( state, branch_counters )
+                add_phase_times( state, branch_times )
+             if people.isdisjoint( state.visited ) and families.isdisjoint( state.visited_fam ):
+                if state.collect_stats:
+                   state.counters['branches-accepted'] += 1
+                state.visited.update( people )
+                state.visited_fam.update( families )
+                for p in links:
+                    state.reached_from[p], state.generations[p], state.matched_pairs[p] = links[p]
+                yield from findings
+             else:
+                # this branch reached people also found by an earlier branch,
+                # so do it again here just as the single process walk would
+                if state.collect_stats:
+                   state.counters['branches-redone'] += 1
+                yield from run_work( state, get_branch_work( state, items ) )
+
+
+def follow_trees( state, p1, p2 ):
+    # generates the findings
+    work = collections.deque()
+    work.append( ('person', p1, p2, None, None) )
+
+    # a batch uses the processes for separate files
+    if state.options['jobs'] > 1 and not state.options['batch']:
+       yield from follow_in_parallel( state, work )
     else:
-       print( 'Tree', i, 'not fully parsed data:', file_names[i], file=sys.stderr )
-       ok = False
+       yield from run_work( state, work )
+
+
+def get_event_details( state, t, p ):
+    # [event] = (days or None, date as given, place), for the events the person has
+    result = dict()
+    for e in detail_events:
+        if get_best_event_id( state, t, p, e ) is not None:
+           date = get_full_date( state, t, p, e )
+           days = None
+           if date:
+              days = day_count( date )
+           place = get_event_place( state, t, p, e )
+           if place is None:
+              place = ''
+           result[e] = (days, get_a_date( state, t, p, e ), place)
+    return result
+
+
+def get_date_differences( state, days1, days2 ):
+    # for each pair of days, true if only one is known or they are too far apart
+    limit = state.options['report-date-diff']
+    if numpy is not None:
+       # all together
+       d1 = numpy.array( [numpy.nan if d is None else d for d in days1], dtype=float )
+       d2 = numpy.array( [numpy.nan if d is None else d for d in days2], dtype=float )
+       known1 = ~numpy.isnan( d1 )
+       known2 = ~numpy.isnan( d2 )
+       with numpy.errstate( invalid='ignore' ):
+            apart = numpy.abs( d1 - d2 ) > limit
+       return ( (known1 != known2) | (known1 & known2 & apart) ).tolist()
+
+    result = []
+    for v1, v2 in zip( days1, days2 ):
+        if v1 is None or v2 is None:
+           result.append( (v1 is None) != (v2 is None) )
+        else:
+           result.append( abs( v1 - v2 ) > limit )
+    return result
+
+
+def detail_finding( kind, relation, p1, p2, event, first, second ):
+    return Finding( kind, relation, p1, p2, event, None, None, {'first':first, 'second':second} )
+
+
+def compare_details( state, pairs ):
+    # return the detail findings of the matched pairs, in the order of the pairs
+    # each detail is compared for all the pairs together
+    found = [[] for pair in pairs]
+    limit = state.options['report-name-diff']
+
+    for i, (p1, p2) in enumerate( pairs ):
+        n1 = get_name( state, 1, p1 )
+        n2 = get_name( state, 2, p2 )
+        if n1 != n2 and get_name_match_value( state, n1, n2 ) < limit:
+           found[i].append( detail_finding( 'different', 'name', p1, p2, None, n1, n2 ) )
+
+    events1 = [get_event_details( state, 1, p1 ) for p1, p2 in pairs]
+    events2 = [get_event_details( state, 2, p2 ) for p1, p2 in pairs]
+
+    for e in detail_events:
+        both = []
+        for i, (p1, p2) in enumerate( pairs ):
+            if e in events1[i]:
+               if e in events2[i]:
+                  both.append( i )
+               else:
+                  found[i].append( detail_finding( 'removed', 'event', p1, p2, e, events1[i][e][1], None ) )
+            elif e in events2[i]:
+               found[i].append( detail_finding( 'added', 'event', p1, p2, e, None, events2[i][e][1] ) )
+
+        days1 = [events1[i][e][0] for i in both]
+        days2 = [events2[i][e][0] for i in both]
+        for i, is_different in zip( both, get_date_differences( state, days1, days2 ) ):
+            if is_different:
+               p1, p2 = pairs[i]
+               found[i].append( detail_finding( 'different', 'date', p1, p2, e, events1[i][e][1], events2[i][e][1] ) )
+
+        for i in both:
+            place1 = events1[i][e][2]
+            place2 = events2[i][e][2]
+            if place1 != place2 and get_name_match_value( state, place1, place2 ) < limit:
+               p1, p2 = pairs[i]
+               found[i].append( detail_finding( 'different', 'place', p1, p2, e, place1, place2 ) )
+
+    if state.collect_stats:
+       state.counters['detail-pairs'] += len( pairs )
+
+    return [finding for pair_found in found for finding in pair_found]
+
+
+def follow_details( state, direction ):
+    # the detail differences of the people matched in this direction,
+    # after the walk so they can be compared together or shared out,
+    # except those pairs already done in the first direction
+    # generates the findings
+    done = set()
+    if direction == 2:
+       done = set( state.direction_pairs[1].items() )
+
+    pairs = []
+    for p1 in state.matched_pairs:
+        if pair_key( state, p1, state.matched_pairs[p1] ) not in done:
+           pairs.append( (p1, state.matched_pairs[p1]) )
+
+    # a batch uses the processes for separate files
+    if state.options['jobs'] > 1 and not state.options['batch'] and len( pairs ) > 1:
+       size = len( pairs ) // state.options['jobs'] + 1
+       parts = [pairs[i:i+size] for i in range( 0, len( pairs ), size )]
+       sys.stdout.flush()
+       with get_process_pool( state, state.options['jobs'] ) as pool:
+            for findings in pool.map( in_worker, itertools.repeat( compare_details ), parts ):
+                yield from findings
+    else:
+       yield from compare_details( state, pairs )
+
+
+def prepare_tree( state, t ):
+    # load the tree and find its start person, then compact it if wanted
+    # return false if the start person is not found
+    load_tree( state, t, state.file_names[t] )
+    if not find_start( state, t ):
+       return False
+    if state.compact_now:
+       # before the next is loaded
+       compact_tree( state, t )
+    return True
+
+
+def prepare_tree_in_worker( state, t ):
+    # the tree is sent back to the main process, with the counts and times of loading it
+    state.counters.clear()
+    state.phase_times.clear()
+    ok = prepare_tree( state, t )
+    return ok, state.trees[t], state.indexes[t], state.starts[t], state.counters, state.phase_times, state.places.names
+
+
+def find_start( state, t ):
+    # replace the given start id with the xref of the person
+    # return False if the person is not found
+    if not is_parsed_tree( state, t ):
+       show_message( state, 'Tree', t, 'not fully parsed data:', state.file_names[t] )
+       return False
+
+    if state.options['lazy']:
+       selected = find_lazy_start( state, t, state.starts[t] )
+    else:
+       selected = state.readgedcom.find_individuals( state.trees[t], state.options['iditem'], state.starts[t] )
+    n = len(selected)
+    if n == 1:
+       state.starts[t] = selected[0]
+       return True
+
+    mess = 'Given person id ' + str(state.starts[t]) + ' '
+    if n < 1:
+       mess += 'not in tree:'
+    else:
+       mess += 'matched more than 1 person:'
+    show_message( state, mess, state.file_names[t] )
+    return False
+
+
+def compare_trees( state, writer ):
+    # write the report of the differences found from the starting persons
+    # return the number of findings of each kind
+
+    found = collections.Counter()
+    state.budget_start = time.perf_counter()
+    state.next_checkpoint = state.budget_start + state.options['checkpoint-interval']
+
+    def write( finding ):
+        writer.write( finding )
+        found[finding.kind] += 1
+        if state.options['checkpoint']:
+           state.written_findings[direction].append( finding )
+
+    if not is_same_person( state, state.starts[1], state.starts[2] ):
+       # don't exit
+       show_message( state, 'WARNING: start persons fail test for same person', state.file_names[2] )
+
+    writer.start()
+
+    # match the trees
+
+    directions = [1]
+    if state.options['both-directions']:
+       directions.append( 2 )
+
+    for direction in directions:
+        if direction == 2:
+           swap_trees( state )
+
+        if state.options['both-directions']:
+           writer.direction()
+
+        # prevent double visitations of the same person
+        state.visited = set()
+        state.visited_fam = set()
+
+        # [tree1 person] = relative through whom they were reached, for the graphs
+        state.reached_from = dict()
+
+        # [tree1 person] = generations above the starting person
+        state.generations = dict()
+
+        # [tree1 person] = their tree2 match, in the order compared
+        state.matched_pairs = dict()
+
+        state.written_findings[direction] = []
+        state.direction_links[direction] = state.reached_from
+        state.direction_pairs[direction] = state.matched_pairs
+
+        # from a checkpoint the findings are written again
+        # then the walk of its direction continues from where it was
+        stage = 'trees'
+        position = 0
+        work = None
+        if state.resume_state and direction <= state.resume_state['direction']:
+           state.reached_from = state.resume_state['links'][direction]
+           state.direction_links[direction] = state.reached_from
+           state.matched_pairs = state.resume_state['pairs'][direction]
+           state.direction_pairs[direction] = state.matched_pairs
+           if direction == state.resume_state['direction']:
+              state.visited = state.resume_state['visited']
+              state.visited_fam = state.resume_state['visited_fam']
+              state.generations = state.resume_state['generations']
+              stage = state.resume_state['stage']
+              position = state.resume_state['position']
+              work = collections.deque( state.resume_state['work'] )
+           for finding in state.resume_state['findings'][direction]:
+               write( finding )
+           if direction < state.resume_state['direction']:
+              continue
+
+        if state.new_baseline:
+           state.saved_steps = dict()
+           state.new_baseline['steps'][direction] = state.saved_steps
+           state.baseline_steps = dict()
+           if state.baseline and direction in state.baseline['steps']:
+              state.baseline_steps = state.baseline['steps'][direction]
+
+        state.walk_state['direction'] = direction
+
+        if stage == 'trees':
+           state.walk_state['stage'] = stage
+           state.walk_state['position'] = 0
+           findings = follow_trees( state, state.starts[1], state.starts[2] )
+           if work is not None:
+              findings = run_work( state, work )
+           work = None
+           position = 0
+           with timed_phase( state, 'compare' ):
+                for finding in findings:
+                    write( finding )
+
+        if state.options['match-all']:
+           state.walk_state['stage'] = 'all'
+           with timed_phase( state, 'match-all' ):
+                for finding in follow_all_people( state, position, work ):
+                    write( finding )
+
+        if state.options['details']:
+           with timed_phase( state, 'details' ):
+                for finding in follow_details( state, direction ):
+                    write( finding )
+
+    writer.close()
+    writer.outf.close()
+
+    if state.trees_swapped:
+       swap_trees( state )
+
+    return found
+
+
+def read_manifest( file_name ):
+    # return [(file, start id)] of the batch
+    # file names are relative to the location of the manifest
+    result = []
+    folder = os.path.dirname( file_name )
+    with open( file_name, newline='' ) as inf:
+         for row in csv.reader( inf ):
+             if not row or row[0].strip().startswith( '#' ):
+                continue
+             if len( row ) != 2:
+                print( 'Batch lines must be file,id:', ','.join( row ), file=sys.stderr )
+                sys.exit(1)
+             result.append( (os.path.join( folder, row[0].strip() ), row[1].strip()) )
+    return result
+
+
+report_extensions = {'text':'txt', 'jsonl':'jsonl', 'graphml':'graphml', 'd3':'json'}
+
 
-ok = check_config( ok )
+def get_report_file( state, file_name ):
+    # named for the compared file
+    name = os.path.splitext( os.path.basename( file_name ) )[0]
+    name += '.' + report_extensions[state.options['format']]
+    return os.path.join( state.options['report-dir'], name )
 
-if not ok:
-   sys.exit(1)
 
-if not is_same_person( starts[1], starts[2] ):
-   # don't exit
-   print( 'WARNING: start persons fail test for same person', file=sys.stderr )
+def compare_batch_file( state, item ):
+    # compare the first tree to one of the batch
+    # return a line of the summary
+    state.file_names[2], state.starts[2] = item
+    result = [state.file_names[2], state.starts[2], 'failed', None, None]
+
+    # pairs of people are only the same within a pair of files
+    state.same_person_results.clear()
+    state.match_value_results.clear()
+    state.subtree_hashes[2].clear()
+
+    try:
+       with timed_phase( state, 'load' ):
+            load_tree( state, 2, state.file_names[2] )
+    except SystemExit:
+       # the library stops on very bad data
+       return result
+    if not find_start( state, 2 ):
+       return result
+    if state.options['compact']:
+       compact_tree( state, 2 )
+
+    report_file = get_report_file( state, state.file_names[2] )
+    found = compare_trees( state, open_output( state, report_file ) )
+
+    result[2] = 'ok'
+    result[3] = report_file
+    result[4] = sum( found.values() )
+    for kind in finding_kinds:
+        result.append( found[kind] )
+    return result
+
+
+def compare_batch_file_in_worker( state, item ):
+    # also return the counts and times for only this file
+    state.counters.clear()
+    state.phase_times.clear()
+    return compare_batch_file( state, item ), state.counters, state.phase_times
+
+
+def compare_batch( state, batch ):
+    # write the summary, in the batch order
+    outf = open_output( state, state.options['output'] ).outf
+    summary = csv.writer( outf )
+    summary.writerow( ['file', 'id', 'status', 'report', 'findings'] + finding_kinds )
+
+    if state.options['jobs'] > 1:
+       with get_process_pool( state, state.options['jobs'] ) as pool:
+            for result, file_counters, file_times in pool.map( in_worker, itertools.repeat( compare_batch_file_in_worker ), batch ):
+                summary.writerow( result )
+                if state.collect_stats:
+                   add_counters( state, file_counters )
+                   add_phase_times( state, file_times )
+    else:
+       for item in batch:
+           summary.writerow( compare_batch_file( state, item ) )
+
+    outf.close()
+
+
+def is_sweep( state ):
+    for item in ['sweep-name-diff','sweep-date-diff','sweep-place-diff']:
+        if state.options[item] is not None:
+           return True
+    return False
+
+
+class CountWriter:
+    # nothing is written, only the number of findings are used
+
+    def __init__( self ):
+        self.outf = io.StringIO()
+
+    def start( self ):
+        pass
+
+    def direction( self ):
+        pass
+
+    def write( self, finding ):
+        pass
+
+    def close( self ):
+        pass
+
+
+def sweep_limits( state ):
+    # compare the trees for each combination of the same person limits,
+    # writing the numbers of people matched and of each kind of finding as csv.
+    # The pair values are kept between the comparisons, which then only
+    # repeat the walk and the pairings.
+    state.sweep_scores = dict()
+
+    values = dict()
+    for item in ['name','date','place']:
+        values[item] = state.options['sweep-' + item + '-diff']
+        if values[item] is None:
+           values[item] = [state.options['person-' + item + '-diff']]
+
+    directions = [1]
+    if state.options['both-directions']:
+       directions.append( 2 )
+
+    outf = open_output( state, state.options['output'] ).outf
+    summary = csv.writer( outf )
+    summary.writerow( ['person-name-diff', 'person-date-diff', 'person-place-diff', 'matched', 'findings'] + finding_kinds )
+
+    for name_diff in values['name']:
+        for date_diff in values['date']:
+            for place_diff in values['place']:
+                state.options['person-name-diff'] = name_diff
+                state.options['person-date-diff'] = date_diff
+                state.options['person-place-diff'] = place_diff
+
+                # the saved decisions depend on the limits, the match values are exact
+                state.same_person_results.clear()
+
+                found = compare_trees( state, CountWriter() )
+                matched = sum( [len( state.direction_pairs[d] ) for d in directions] )
+                row = [name_diff, date_diff, place_diff, matched, sum( found.values() )]
+                summary.writerow( row + [found[kind] for kind in finding_kinds] )
+
+                if state.collect_stats:
+                   state.counters['sweep-settings'] += 1
+
+    outf.close()
+
+
+# the options which a comparison request can change, with their types
+request_options = {'format':str, 'iditem':str, 'traversal':str, 'matcher':str,
+                   'person-name-diff':float, 'person-date-diff':int, 'person-place-diff':float,
+                   'place-parts':bool, 'report-name-diff':float, 'report-date-diff':int, 'details':bool,
+                   'both-directions':bool, 'match-all':bool,
+                   'scope':str, 'generations-up':int, 'generations-down':int,
+                   'time-limit':float, 'max-compared':int}
+
+request_choices = {'format':writers, 'traversal':['depth','breadth'], 'matcher':matchers,
+                   'scope':['all','ancestors','descendants']}
+
+content_types = {'text':'text/plain; charset=utf-8', 'jsonl':'application/x-ndjson',
+                 'graphml':'application/xml', 'd3':'application/json'}
+
+
+def get_request_options( state, request ):
+    # the options of the server, changed by those in the request
+    return change_options( state.options, request.get( 'options', dict() ) )
+
+
+def change_options( start, changes ):
+    # a copy of the options, with changes to those which a comparison can change
+    result = dict( start )
+    for item in changes:
+        if item not in request_options:
+           raise ValueError( 'Unknown option ' + item )
+        wanted_type = request_options[item]
+        if wanted_type is bool and not isinstance( changes[item], bool ):
+           raise ValueError( item + ' must be true or false' )
+        value = wanted_type( changes[item] )
+        if item in request_choices and value not in request_choices[item]:
+           raise ValueError( 'Unknown ' + item + ' ' + str(value) )
+        result[item] = value
+    return result
+
+
+def get_served_tree( state, file_name ):
+    # load the file unless it is loaded and unchanged since
+    # return the key of the tree, which is the file hash
+    info = os.stat( file_name )
+    file_state = (info.st_size, info.st_mtime_ns)
+    if file_name not in served_files or served_files[file_name][0] != file_state:
+       key = get_file_hash( file_name )
+       if key not in served_trees:
+          print( 'Loading', file_name, file=sys.stderr )
+          with timed_phase( state, 'load' ):
+               load_tree( state, 1, file_name )
+          served_trees[key] = (state.trees[1], state.indexes[1])
+       served_files[file_name] = (file_state, key)
+
+       # forget the trees of files which have since changed
+       in_use = set( [served_files[f][1] for f in served_files] )
+       for old_key in list( served_trees ):
+           if old_key not in in_use:
+              del served_trees[old_key]
+
+    return served_files[file_name][1]
+
+
+class ComparisonHandler( http.server.BaseHTTPRequestHandler ):
+    # POST /compare with a json object of file1, id1, file2, id2
+    # and optionally options: {name:value}, answered with the report
+
+    error_content_type = 'text/plain; charset=utf-8'
+    error_message_format = '%(code)d %(message)s\n%(explain)s\n'
+
+    def do_POST( self ):
+        if self.path != '/compare':
+           self.send_error( 404 )
+           return
+
+        state = self.server.state
+
+        try:
+           length = int( self.headers.get( 'Content-Length', 0 ) )
+           request = json.loads( self.rfile.read( length ) )
+           names = [request['file1'], request['file2']]
+           ids = [str( request['id1'] ), str( request['id2'] )]
+           settings = get_request_options( state, request )
+           if names[0].lower() == names[1].lower():
+              raise ValueError( 'Identical files' )
+           # loaded here so that later requests can use them
+           keys = [get_served_tree( state, f ) for f in names]
+        except KeyError as e:
+           self.send_error( 400, explain='Missing ' + str(e) )
+           return
+        except (ValueError, TypeError, AttributeError, OSError) as e:
+           self.send_error( 400, explain=str(e) )
+           return
+        except SystemExit:
+           # the library stops on very bad data
+           self.send_error( 400, explain='Unreadable file' )
+           return
+
+        # each comparison runs in its own process, with a copy of the loaded trees
+        if os.fork() == 0:
+           status = 1
+           try:
+              self.server.socket.close()
+              self.compare( names, ids, keys, settings )
+              status = 0
+           except Exception:
+              traceback.print_exc()
+           finally:
+              os._exit( status )
+
+    def compare( self, names, ids, keys, settings ):
+        # the loaded trees use the place table of the server
+        state = Comparison( self.server.state.readgedcom, settings )
+        state.places = self.server.state.places
+
+        for t in [1,2]:
+            state.file_names[t] = names[t-1]
+            state.starts[t] = ids[t-1]
+            state.trees[t], state.indexes[t] = served_trees[keys[t-1]]
+
+        # problems with the request go back to the client
+        state.messages = []
+        ok = True
+        for t in [1,2]:
+            if not find_start( state, t ):
+               ok = False
+        ok = check_config( state, ok )
+        if not ok:
+           self.send_error( 400, explain='\n'.join( state.messages ) )
+           return
+        # and the warnings of the comparison to the server
+        state.messages = None
+
+        self.send_response( 200 )
+        self.send_header( 'Content-Type', content_types[settings['format']] )
+        self.end_headers()
+
+        outf = io.TextIOWrapper( self.wfile, encoding='utf-8' )
+        compare_trees( state, writers[settings['format']]( state, outf ) )
+
+    def address_string( self ):
+        # a unix socket has no client address
+        if isinstance( self.client_address, tuple ):
+           return self.client_address[0]
+        return 'local'
+
+
+class ComparisonServerMixIn:
+
+    def service_actions( self ):
+        # collect the finished comparisons
+        try:
+           while os.waitpid( -1, os.WNOHANG )[0] > 0:
+                 pass
+        except ChildProcessError:
+           pass
+
+    def shutdown_request( self, request ):
+        # only close, the connection might still be in use by a comparison process
+        self.close_request( request )
+
+
+class TCPComparisonServer( ComparisonServerMixIn, http.server.HTTPServer ):
+    pass
+
+
+class UnixComparisonServer( ComparisonServerMixIn, socketserver.UnixStreamServer ):
+    pass
+
+
+def serve_comparisons( state ):
+    address = state.options['serve']
+    if '/' in address:
+       if os.path.exists( address ):
+          if not stat.S_ISSOCK( os.stat( address ).st_mode ):
+             print( 'Server address exists and is not a socket:', address, file=sys.stderr )
+             sys.exit(1)
+          os.remove( address )
+       server = UnixComparisonServer( address, ComparisonHandler )
+    else:
+       host, _, port = address.rpartition( ':' )
+       if not port.isdigit():
+          print( 'Server address must be host:port or a socket path:', address, file=sys.stderr )
+          sys.exit(1)
+       server = TCPComparisonServer( (host, int( port )), ComparisonHandler )
+
+    # the trees are loaded with this one, each comparison has its own
+    server.state = state
+
+    print( 'Serving comparisons at', address, file=sys.stderr )
+    try:
+       server.serve_forever()
+    except KeyboardInterrupt:
+       pass
+    server.server_close()
+    if '/' in address:
+       os.remove( address )
+
+
+class ListWriter:
+    # the findings are kept, in the form of the jsonl report with the words of the text report
+
+    def __init__( self, state ):
+        self.state = state
+        self.outf = io.StringIO()
+        self.findings = []
+
+    def start( self ):
+        pass
+
+    def direction( self ):
+        pass
+
+    def write( self, finding ):
+        data = finding._asdict()
+        data['direction'] = 'second-to-first' if self.state.trees_swapped else 'first-to-second'
+        data['message'] = ' '.join( get_finding_message( self.state, finding ) )
+        self.findings.append( data )
+
+    def close( self ):
+        pass
+
+
+class PlaceIndex( dict ):
+    # the index of a tree made by a Comparator, along with the place table of its place ids
+    pass
+
+
+def get_library_places():
+    # the place table for the indexes of Comparators,
+    # started again when too many places have been kept
+    global library_places
+    if len( library_places.names ) > place_table_size:
+       library_places = PlaceTable()
+    return library_places
+
+
+def use_place_table( state, index ):
+    # an index made with another place table is copied with the ids of this one,
+    # it may be in use by other comparisons
+    if isinstance( index, PlaceIndex ) and index.places is not state.places:
+       result = PlaceIndex( [(p, copy.copy( index[p] )) for p in index] )
+       adopt_places( state, result, index.places.names )
+       result.places = state.places
+       return result
+    return index
+
+
+class Comparator:
+    # for use as a library: compare trees already parsed, with settings and saved results
+    # kept apart from those of other comparators.
+    # Each comparison has its own state, so comparisons can run in several threads at once.
+
+    def __init__( self, library, settings=None ):
+        # library: the readgedcom module
+        # settings: [option] = value, those which a server request can change
+        self.library = library
+        self.options = change_options( get_default_options(), settings or dict() )
+
+        # the ratios are kept for the next comparisons, those of places with their place table
+        self.name_match_results = collections.OrderedDict()
+        self.place_results = (None, collections.OrderedDict())
+
+    def get_state( self, places ):
+        # a new comparison, with the saved ratios
+        result = Comparison( self.library, self.options )
+        result.messages = []
+        result.name_match_results = self.name_match_results
+        result.places = places
+        table, result.place_match_results = self.place_results
+        if table is not places:
+           result.place_match_results = collections.OrderedDict()
+           self.place_results = (places, result.place_match_results)
+        return result
+
+    def index( self, tree ):
+        # the values used for person matching, to give with the tree to each comparison.
+        # The index can be used by any comparator.
+        state = self.get_state( get_library_places() )
+        state.trees[1] = tree
+        result = PlaceIndex( build_person_index( state, 1 ) )
+        result.places = state.places
+        return result
+
+    def compare( self, tree1, id1, tree2, id2, index1=None, index2=None ):
+        # the trees as parsed by the library, and the starting person in each as given to the program,
+        # with their indexes from Comparator.index if made before
+        # return the Report of the findings, as dicts, and the warnings
+        # raise ValueError if the trees or settings can't be compared
+        places = get_library_places()
+        for index in [index2, index1]:
+            if isinstance( index, PlaceIndex ):
+               places = index.places
+        state = self.get_state( places )
+
+        for t, tree, start, index in [(1, tree1, id1, index1), (2, tree2, id2, index2)]:
+            state.trees[t] = tree
+            state.starts[t] = start
+            state.indexes[t] = use_place_table( state, index )
+            state.file_names[t] = 'tree' + str(t)
+
+        ok = True
+        for t in [1,2]:
+            if not find_start( state, t ):
+               ok = False
+            elif state.indexes[t] is None:
+               state.indexes[t] = build_person_index( state, t )
+        ok = check_config( state, ok )
+        if not ok:
+           raise ValueError( '\n'.join( state.messages ) )
+
+        writer = ListWriter( state )
+        compare_trees( state, writer )
+        return Report( writer.findings, state.messages )
+
+
+# a difference between the trees, as seen from a tree1 person (xref1)
+# and their matched tree2 person (xref2)
+#   kind: added, removed, different, unmatched, not-found, unexplored
+#   relation: parent, parents, partner, partners, child, children, person
+#     or people for those not compared by --match-all
+#   role: wife or husb for a parent
+#   partner: tree1 partner of xref1 for children
+#   other: the tree1 person not matched
+#   scores: the same person test values for a different parent
+# or for the details of a matched pair
+#   kind: added, removed, different
+#   relation: name, date, place, event
+#   role: the event
+#   scores: the first and second values
+Finding = collections.namedtuple( 'Finding', 'kind relation xref1 xref2 role partner other scores' )
+
+finding_kinds = ['added', 'removed', 'different', 'unmatched', 'not-found', 'unexplored']
+
+# the result of a library comparison, the findings as dicts
+# and the warnings which the program would show on standard error
+Report = collections.namedtuple( 'Report', 'findings warnings' )
+
+
+class PlaceTable:
+    # the places of the trees as numbers, [normalized place] = id, and the place of each id.
+    # It can be shared by comparisons in several threads
+
+    def __init__( self ):
+        self.ids = dict()
+        self.names = []
+        self.lock = threading.Lock()
+
+    def get_id( self, place ):
+        result = self.ids.get( place )
+        if result is None:
+           with self.lock:
+                result = self.ids.get( place )
+                if result is None:
+                   result = len( self.names )
+                   self.names.append( place )
+                   self.ids[place] = result
+        return result
 
-# match the trees
 
-# prevent double visitations of the same person
-visited = []
-visited_fam = []
+class Comparison:
+    # the values of one comparison of two trees, given to the functions which use them
 
-follow_person( starts[1], starts[2] )
+    def __init__( self, library, options ):
+        self.options = options
+
+        # the gedcom library, and its keys of the parsed data
+        self.readgedcom = library
+        self.ikey = library.PARSED_INDI
+        self.fkey = library.PARSED_FAM
+
+        # the tree data, with an initial zero'th element so that the rest of the program uses 1 and 2
+        self.trees = [0, None, None]
+        self.indexes = [0, None, None]
+        self.starts = [0, None, None]
+        self.file_names = [0, None, None]
+
+        # the baseline needs the parsed data of both trees
+        self.compact_now = False
+
+        # for the comparisons of each direction
+        self.visited = set()
+        self.visited_fam = set()
+        self.reached_from = dict()
+        self.generations = dict()
+        self.matched_pairs = dict()
+        self.budget_start = 0.0
+
+        # the visits made before the processes of a parallel walk started
+        self.branch_visited = frozenset()
+        self.branch_visited_fam = frozenset()
+
+        # for --stats, [phase] = [wall, cpu] seconds
+        self.collect_stats = options['stats'] is not None
+        self.phase_times = dict()
+        self.counters = collections.Counter()
+
+        # name ratios, most recently used last
+        self.name_match_results = collections.OrderedDict()
+
+        # the places of both trees as numbers
+        self.places = PlaceTable()
+        # [(id1, id2)] = place ratio, most recently used last
+        self.place_match_results = collections.OrderedDict()
+
+        # person pair results, shared by both directions
+        self.same_person_results = dict()
+        self.match_value_results = dict()
+        self.trees_swapped = False
+
+        # for --baseline, the records which need comparing again, in each tree
+        self.dirty_people = [0, set(), set()]
+        self.dirty_families = [0, set(), set()]
+
+        # for a sweep, [pair key] = (name, date, place) values
+        self.sweep_scores = None
+
+        # [person] = hash of their ancestors or descendants, as the scope, in each tree
+        self.subtree_hashes = [0, dict(), dict()]
+
+        # [step key] = work, from the previous run and for the next
+        self.baseline = None
+        self.new_baseline = None
+        self.baseline_steps = dict()
+        self.saved_steps = None
+
+        # for --checkpoint, where the walk is and what it has written in each direction
+        self.walk_state = {'direction':1, 'stage':'trees', 'position':0, 'work':None}
+        self.written_findings = dict()
+        self.direction_links = dict()
+        self.direction_pairs = dict()
+        self.checkpoint_settings = None
+        self.resume_state = None
+        self.next_checkpoint = 0.0
+        self.stop_requested = False
+
+        # problems and warnings are shown on standard error,
+        # or kept here for a library comparison
+        self.messages = None
+
+
+# the comparison of a worker process, set as the pool starts it
+worker_state = None
+
+# the place table for the indexes made by Comparators
+library_places = PlaceTable()
+
+# for --serve, [file name] = (size and time, hash) and [hash] = (tree, index)
+served_files = dict()
+served_trees = dict()
+
+if __name__ == '__main__':
+   options = get_program_options()
+
+   profiler = None
+   if options['profile']:
+      profiler = cProfile.Profile()
+      profiler.enable()
+
+   state = Comparison( load_my_module( 'readgedcom', options['libpath'] ), options )
+
+   # the cache is used before the other options are checked
+   if options['cache-dir']:
+      if not os.path.isdir( options['cache-dir'] ):
+         print( 'Cache directory does not exist:', options['cache-dir'], file=sys.stderr )
+         sys.exit(1)
+      if options['cache-size'] < 1:
+         print( 'cache-size cannot be less than one', file=sys.stderr )
+         sys.exit(1)
+      if options['lazy']:
+         print( 'The cache cannot be used with lazy reading', file=sys.stderr )
+         sys.exit(1)
+
+   if options['serve']:
+      if not check_config( state, True ):
+         sys.exit(1)
+      serve_comparisons( state )
+      sys.exit(0)
+
+   state.file_names[1] = options['file1']
+   state.starts[1] = options['id1']
+
+   batch = None
+   if options['batch']:
+      batch = read_manifest( options['batch'] )
+      others = [item[0] for item in batch]
+      reports = [get_report_file( state, f ) for f in others]
+      for f in others:
+          if not os.path.isfile( f ):
+             print( 'Batch file does not exist:', f, file=sys.stderr )
+             sys.exit(1)
+      if len( set( reports ) ) < len( reports ):
+         print( 'Batch files must have different names, for the reports', file=sys.stderr )
+         sys.exit(1)
+   else:
+      state.file_names[2] = options['file2']
+      state.starts[2] = options['id2']
+      others = [state.file_names[2]]
+
+   # not good for o/s with significant case files
+   for f in others:
+       if state.file_names[1].lower() == f.lower():
+          print( 'Identical files', f, file=sys.stderr )
+          sys.exit(1)
+
+   # in a batch the others are loaded as they are compared
+   tree_numbers = [1,2]
+   if batch:
+      tree_numbers = [1]
+
+   ok = True
+
+   # the baseline needs the parsed data of both trees
+   state.compact_now = options['compact'] and not options['baseline']
+
+   # loading the trees at the same time is slower with only one processor to share
+   concurrent_load = options['jobs'] > 1 and ( os.cpu_count() or 1 ) > 1
+
+   if concurrent_load and len( tree_numbers ) > 1 and not options['lazy']:
+      # the second tree is loaded by another process at the same time
+      sys.stdout.flush()
+      with timed_phase( state, 'load' ):
+           with get_process_pool( state, 1 ) as pool:
+                other = pool.submit( in_worker, prepare_tree_in_worker, 2 )
+                if not prepare_tree( state, 1 ):
+                   ok = False
+                other_ok, state.trees[2], state.indexes[2], state.starts[2], other_counters, other_times, other_places = other.result()
+      if other_ok:
+         adopt_places( state, state.indexes[2], other_places )
+      else:
+         ok = False
+      if state.collect_stats:
+         add_counters( state, other_counters )
+         add_phase_times( state, other_times )
+
+   else:
+      for i in tree_numbers:
+          with timed_phase( state, 'load' ):
+               load_tree( state, i, state.file_names[i] )
+          if not find_start( state, i ):
+             ok = False
+          elif state.compact_now:
+             # before the next is loaded
+             compact_tree( state, i )
+
+   ok = check_config( state, ok )
+
+   if not ok:
+      sys.exit(1)
+
+   if options['baseline']:
+      with timed_phase( state, 'baseline' ):
+           state.baseline = read_baseline( state, options['baseline'] )
+           # the record hashes of each tree, and the work from each pair compared
+           # in each direction, which are the pairings and findings
+           state.new_baseline = {'settings':get_baseline_settings( state ), 'hashes':[0], 'steps':dict()}
+           for i in [1,2]:
+               state.new_baseline['hashes'].append( get_record_hashes( state, i ) )
+               if state.baseline:
+                  dirty = get_dirty_records( state, i, state.new_baseline['hashes'][i], state.baseline['hashes'][i] )
+                  state.dirty_people[i], state.dirty_families[i] = dirty
+
+   if options['compact'] and not state.compact_now:
+      for i in tree_numbers:
+          compact_tree( state, i )
+
+   if options['checkpoint']:
+      state.checkpoint_settings = get_checkpoint_settings( state )
+      if options['resume']:
+         state.resume_state = read_checkpoint( state, options['checkpoint'] )
+      signal.signal( signal.SIGINT, lambda signum, frame: request_stop( state ) )
+      signal.signal( signal.SIGTERM, lambda signum, frame: request_stop( state ) )
+
+   if batch:
+      compare_batch( state, batch )
+   elif is_sweep( state ):
+      sweep_limits( state )
+   else:
+      compare_trees( state, open_output( state, options['output'] ) )
+
+   if options['checkpoint'] and os.path.isfile( options['checkpoint'] ):
+      os.remove( options['checkpoint'] )
+
+   if state.new_baseline:
+      with timed_phase( state, 'baseline' ):
+           write_pickle( options['baseline'], state.new_baseline )
+
+   if profiler:
+      profiler.disable()
+      profiler.dump_stats( options['profile'] )
+
+   if state.collect_stats:
+      show_stats( state )